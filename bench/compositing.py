@@ -0,0 +1,137 @@
+"""
+Compare Wall compositing backends: render time, peak memory and file size.
+
+    python bench/compositing.py [--width 7680] [--height 4320] [--repeat 3]
+
+Each backend renders in its own process so peak RSS isn't shared.
+"""
+
+import argparse
+import io
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from jopaper.generator import LogTracer  # noqa: E402
+from jopaper.layout import BACKENDS, SubImage, Wall  # noqa: E402
+from PIL import Image  # noqa: E402
+import numpy as np  # noqa: E402
+
+
+def make_sources(dirname, layouts):
+    rng = np.random.default_rng(0)
+    sources = {}
+    for name, sizes in layouts.items():
+        sources[name] = []
+        for n, (w, h) in enumerate(sizes):
+            filename = os.path.join(dirname, f"{name}-{n}.jpeg")
+            noise = rng.integers(0, 255, (h // 8, w // 8, 3), dtype=np.uint8)
+            Image.fromarray(noise).resize((w, h)).save(filename, quality=90)
+            sources[name].append((filename, w, h))
+    return sources
+
+
+class _SizeCounter(io.RawIOBase):
+    """
+    Discards what is written but its size
+    """
+
+    def __init__(self):
+        self.size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.size += len(data)
+        return len(data)
+
+
+def render(sources, backend, width, height):
+    """
+    Return the size of the encoded wallpaper
+    """
+    wall = Wall(width, height, backend=backend)
+    for filename, w, h in sources:
+        sub = SubImage(filename, w, h)
+        sub.to_box(0, 0, width / len(sources), height)
+        wall.add(sub)
+    out = _SizeCounter()
+    wall.write_png(out, LogTracer(logging.getLogger(__name__)))
+    return out.size
+
+
+def peak_rss_kib():
+    # ru_maxrss survives exec on Linux and would include the parent's peak
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_child(args):
+    sources = json.loads(args.sources)
+    baseline = peak_rss_kib()
+    times = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        size = render(sources, args.backend, args.width, args.height)
+        times.append(time.perf_counter() - start)
+    peak = peak_rss_kib() - baseline
+    print(json.dumps({"time": min(times), "peak_kib": peak, "size": size}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--width", type=int, default=7680)
+    parser.add_argument("--height", type=int, default=4320)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--backend", choices=BACKENDS, help=argparse.SUPPRESS)
+    parser.add_argument("--sources", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.backend:
+        run_child(args)
+        return
+
+    w, h = args.width, args.height
+    layouts = {
+        "single": [(w * 3 // 2, h * 3 // 2)],
+        "row": [(w // 4 * 3 // 2, h * 3 // 2)] * 4,
+    }
+    with tempfile.TemporaryDirectory() as dirname:
+        sources = make_sources(dirname, layouts)
+        print(f"{w}x{h}, best of {args.repeat}")
+        print(
+            f"{'layout':<8} {'backend':<8} {'time, s':>8} {'peak, MiB':>10} "
+            f"{'size, MiB':>10}"
+        )
+        for name, layout in sources.items():
+            for backend in BACKENDS:
+                result = subprocess.run(
+                    [sys.executable, __file__, "--backend", backend]
+                    + ["--width", str(w), "--height", str(h)]
+                    + ["--repeat", str(args.repeat), "--sources", json.dumps(layout)],
+                    capture_output=True,
+                    text=True,
+                    check=True,
+                )
+                r = json.loads(result.stdout)
+                print(
+                    f"{name:<8} {backend:<8} {r['time']:>8.2f} "
+                    f"{r['peak_kib'] / 1024:>10.1f} {r['size'] / 2**20:>10.2f}"
+                )
+
+
+if __name__ == "__main__":
+    main()
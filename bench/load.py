@@ -0,0 +1,456 @@
+"""
+Load test the server end to end against a stub upstream.
+
+    python bench/load.py [--duration 120] [--rate 10] [--burst-rate 50] ...
+
+Starts a stub joyreactor (GraphQL posts and generated images), runs the
+app with uvicorn against it in a temporary storage root and replays
+traffic: a weighted mix of resolutions, new sessions arriving all the
+time (churning past the per-resolution session limit, lowered for the
+run with --max-sessions) and periodic bursts. Every interval it reports
+request latency percentiles, error rate, open generators, the most
+sessions a generator's cache tracks, image downloads per rendered
+wallpaper and server memory, then a summary for the run.
+"""
+
+import argparse
+import asyncio
+import base64
+import http.server
+import io
+import json
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+import httpx
+import numpy as np
+from PIL import Image
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Picture sizes the stub upstream serves: landscape, wide, portrait, tall
+STUB_SIZES = [(1920, 1080), (2560, 1440), (3440, 1440), (1200, 1800), (600, 1400)]
+
+
+class StubUpstream:
+    """
+    Serves random GraphQL post pages and generated images in place of
+    joyreactor
+    """
+
+    def __init__(self, posts_per_page=10, latency=0.0):
+        self.posts_per_page = posts_per_page
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.next_id = 0
+        self.sizes = {}
+        self.images = {}
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+
+    def posts(self):
+        posts = []
+        with self.lock:
+            for _ in range(self.posts_per_page):
+                attributes = []
+                for _ in range(random.randint(1, 3)):
+                    self.next_id += 1
+                    size = random.choice(STUB_SIZES)
+                    self.sizes[str(self.next_id)] = size
+                    image_id = f"PostAttributePicture:{self.next_id}"
+                    attributes.append(
+                        {
+                            "image": {
+                                "width": size[0],
+                                "height": size[1],
+                                "type": "JPEG",
+                            },
+                            "id": base64.b64encode(image_id.encode()).decode(),
+                            "post": {"tags": [{"seoName": "stub"}]},
+                        }
+                    )
+                posts.append({"attributes": attributes})
+        return {"data": {"search": {"postPager": {"posts": posts}}}}
+
+    def image(self, image_id):
+        with self.lock:
+            size = self.sizes.get(image_id)
+            if size is None:
+                return None
+            data = self.images.get(size)
+        if data is None:
+            data = _make_jpeg(*size)
+            with self.lock:
+                self.images[size] = data
+        return data
+
+    def _handler(self):
+        stub = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                time.sleep(stub.latency)
+                self._reply(200, "application/json", json.dumps(stub.posts()).encode())
+
+            def do_GET(self):
+                time.sleep(stub.latency)
+                match = re.search(r"-(\d+)\.\w+$", self.path)
+                data = stub.image(match.group(1)) if match else None
+                if data is None:
+                    self._reply(404, "text/plain", b"not found")
+                else:
+                    self._reply(200, "image/jpeg", data)
+
+            def _reply(self, code, content_type, body):
+                self.send_response(code)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+def _make_jpeg(width, height):
+    rng = np.random.default_rng(width * height)
+    noise = rng.integers(0, 255, (height // 16 + 1, width // 16 + 1, 3), np.uint8)
+    buff = io.BytesIO()
+    Image.fromarray(noise).resize((width, height)).save(buff, "JPEG", quality=85)
+    return buff.getvalue()
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _rss_mib(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def _parse_resolutions(spec):
+    """
+    "1920x1080:5,3840x2160:1" -> [((1920, 1080), 5), ((3840, 2160), 1)]
+    """
+    resolutions = []
+    for item in spec.split(","):
+        size, _, weight = item.partition(":")
+        w, h = size.split("x")
+        resolutions.append(((int(w), int(h)), float(weight or 1)))
+    return resolutions
+
+
+class Stats:
+    def __init__(self):
+        self.window = []
+        self.total = []
+        self.errors = 0
+        self.window_errors = 0
+        self.series = []
+
+    def record(self, latency, ok):
+        self.window.append(latency)
+        self.total.append(latency)
+        if not ok:
+            self.errors += 1
+            self.window_errors += 1
+
+    def flush(self, t, generators, sessions, downloads, rss, interval):
+        n = len(self.window)
+        row = {
+            "t": round(t, 1),
+            "rps": n / interval,
+            "errors": self.window_errors / n if n else 0.0,
+            "generators": generators,
+            "sessions": sessions,
+            "downloads_per_wallpaper": downloads,
+            "rss_mib": rss,
+            **_percentiles(self.window),
+        }
+        self.series.append(row)
+        self.window = []
+        self.window_errors = 0
+        return row
+
+
+def _percentiles(latencies):
+    if not latencies:
+        return {"p50": None, "p90": None, "p99": None, "max": None}
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+    return {"p50": p50, "p90": p90, "p99": p99, "max": max(latencies)}
+
+
+def _fmt(value, spec):
+    return format(value, spec) if value is not None else "-".rjust(int(spec[:-3]))
+
+
+def _print_row(row):
+    print(
+        f"{row['t']:>6.1f} {row['rps']:>6.1f} "
+        f"{_fmt(row['p50'], '7.3f')} {_fmt(row['p90'], '7.3f')} "
+        f"{_fmt(row['p99'], '7.3f')} {row['errors']:>6.1%} "
+        f"{_fmt(row['generators'], '4.0f')} "
+        f"{_fmt(row['sessions'], '5.0f')} "
+        f"{_fmt(row['downloads_per_wallpaper'], '7.2f')} "
+        f"{_fmt(row['rss_mib'], '8.1f')}",
+        flush=True,
+    )
+
+
+async def _request(client, args, resolutions, weights, sessions, stats):
+    if not sessions or random.random() < args.new_session:
+        sessions.append(uuid.uuid4().hex)
+        del sessions[: -args.active_sessions]
+    session_id = random.choice(sessions)
+    screen_w, screen_h = random.choices(resolutions, weights)[0]
+    params = {"session_id": session_id, "screen_w": screen_w, "screen_h": screen_h}
+    prefetch = random.random() < args.prefetch
+    if prefetch:
+        params["count"] = args.prefetch_count
+
+    start = time.monotonic()
+    ok = False
+    try:
+        if prefetch:
+            response = await client.get("/wallpapers", params=params)
+            ok = response.status_code == 200
+            for url in response.json()["urls"] if ok else []:
+                ok = ok and (await client.get(url)).status_code == 200
+        else:
+            response = await client.get("/wallpaper", params=params)
+            ok = response.status_code == 200 and len(response.content) > 0
+    except (httpx.HTTPError, ValueError, KeyError):
+        ok = False
+    stats.record(time.monotonic() - start, ok)
+
+
+async def _sample(client, pid, stats, start, interval, stop):
+    while not stop.is_set():
+        try:
+            await asyncio.wait_for(stop.wait(), interval)
+        except TimeoutError:
+            pass
+        generators = sessions = downloads = None
+        try:
+            state = (await client.get("/debug/generators")).json()
+            generators = len(state["generators"])
+            sessions = max(
+                (g["cache"]["sessions"] for g in state["generators"].values()),
+                default=0,
+            )
+            # Of the generators alive now, evicted ones take their counts along
+            downloaded = sum(g["downloaded"] for g in state["generators"].values())
+            rendered = sum(g["rendered"] for g in state["generators"].values())
+            downloads = downloaded / rendered if rendered else None
+        except (httpx.HTTPError, ValueError, KeyError):
+            pass
+        row = stats.flush(
+            time.monotonic() - start,
+            generators,
+            sessions,
+            downloads,
+            _rss_mib(pid),
+            interval,
+        )
+        _print_row(row)
+
+
+async def _run_load(args, base_url, pid):
+    weighted = _parse_resolutions(args.resolutions)
+    resolutions = [r for r, w in weighted]
+    weights = [w for r, w in weighted]
+    sessions = []
+    stats = Stats()
+    limits = httpx.Limits(max_connections=args.max_connections)
+    timeout = httpx.Timeout(args.timeout)
+
+    print(
+        f"{'t, s':>6} {'rps':>6} {'p50, s':>7} {'p90, s':>7} {'p99, s':>7} "
+        f"{'errors':>6} {'gens':>4} {'sess':>5} {'dl/wall':>7} {'rss, MiB':>8}"
+    )
+    async with httpx.AsyncClient(
+        base_url=base_url, limits=limits, timeout=timeout
+    ) as client:
+        start = time.monotonic()
+        stop = asyncio.Event()
+        sampler = asyncio.create_task(
+            _sample(client, pid, stats, start, args.interval, stop)
+        )
+        tasks = set()
+        while (elapsed := time.monotonic() - start) < args.duration:
+            bursting = elapsed % args.burst_period < args.burst_length
+            rate = args.burst_rate if bursting else args.rate
+            await asyncio.sleep(random.expovariate(rate))
+            task = asyncio.create_task(
+                _request(client, args, resolutions, weights, sessions, stats)
+            )
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        await asyncio.gather(*tasks)
+        stop.set()
+        await sampler
+
+    total = len(stats.total)
+    summary = {
+        "requests": total,
+        "errors": stats.errors / total if total else 0.0,
+        **_percentiles(stats.total),
+        "max_generators": max(
+            (r["generators"] for r in stats.series if r["generators"] is not None),
+            default=None,
+        ),
+        "max_sessions": max(
+            (r["sessions"] for r in stats.series if r["sessions"] is not None),
+            default=None,
+        ),
+        "max_rss_mib": max(
+            (r["rss_mib"] for r in stats.series if r["rss_mib"] is not None),
+            default=None,
+        ),
+    }
+    print(
+        f"\n{total} requests, {summary['errors']:.1%} errors, latency "
+        f"p50 {_fmt(summary['p50'], '.3f')} s, p90 {_fmt(summary['p90'], '.3f')} s, "
+        f"p99 {_fmt(summary['p99'], '.3f')} s, max {_fmt(summary['max'], '.3f')} s"
+    )
+    return {"summary": summary, "series": stats.series}
+
+
+def _start_server(args, upstream, fs_root):
+    port = _free_port()
+    env = dict(
+        os.environ,
+        FS_ROOT=fs_root,
+        DEBUG_ENDPOINTS="1",
+        JOYREACTOR_API_URL=f"{upstream.url}/graphql",
+        JOYREACTOR_IMAGE_URL=f"{upstream.url}/pics",
+        MAX_SESSIONS_PER_GENERATOR=str(args.max_sessions),
+        **dict(kv.split("=", 1) for kv in args.env),
+    )
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "jopaper.api:app"]
+        + ["--port", str(port), "--log-level", "warning"],
+        cwd=ROOT,
+        env=env,
+        stdout=subprocess.DEVNULL if not args.server_logs else None,
+        stderr=subprocess.DEVNULL if not args.server_logs else None,
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(f"{base_url}/rwg3").status_code == 200:
+                return server, base_url
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    server.terminate()
+    raise RuntimeError("Server didn't start")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--duration", type=float, default=120, help="Seconds")
+    parser.add_argument("--rate", type=float, default=10, help="Requests/s")
+    parser.add_argument(
+        "--burst-rate", type=float, default=50, help="Requests/s during bursts"
+    )
+    parser.add_argument("--burst-period", type=float, default=30, help="Seconds")
+    parser.add_argument("--burst-length", type=float, default=5, help="Seconds")
+    parser.add_argument(
+        "--resolutions",
+        default="1920x1080:6,2560x1440:2,3840x2160:1,1080x1920:1,3440x1440:1",
+        help="Weighted resolution mix, WxH:weight,...",
+    )
+    parser.add_argument(
+        "--new-session",
+        type=float,
+        default=0.5,
+        help="Probability a request starts a new session",
+    )
+    parser.add_argument(
+        "--active-sessions",
+        type=int,
+        default=200,
+        help="Recent sessions returning requests are drawn from",
+    )
+    parser.add_argument(
+        "--max-sessions",
+        type=int,
+        default=100,
+        help="Sessions each generator's cache tracks, low enough to churn past",
+    )
+    parser.add_argument(
+        "--prefetch",
+        type=float,
+        default=0.1,
+        help="Share of requests prefetching through /wallpapers",
+    )
+    parser.add_argument("--prefetch-count", type=int, default=5)
+    parser.add_argument("--max-connections", type=int, default=100)
+    parser.add_argument("--timeout", type=float, default=60, help="Request timeout")
+    parser.add_argument("--interval", type=float, default=5, help="Report interval")
+    parser.add_argument(
+        "--upstream-latency", type=float, default=0.05, help="Stub upstream delay"
+    )
+    parser.add_argument(
+        "--env",
+        action="append",
+        default=[],
+        help="Extra server environment, NAME=VALUE (repeatable)",
+    )
+    parser.add_argument("--server-logs", action="store_true")
+    parser.add_argument("--json", help="Write the summary and series to a file")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    upstream = StubUpstream(latency=args.upstream_latency)
+    upstream.start()
+    with tempfile.TemporaryDirectory() as fs_root:
+        server, base_url = _start_server(args, upstream, fs_root)
+        try:
+            result = asyncio.run(_run_load(args, base_url, server.pid))
+        finally:
+            server.terminate()
+            server.wait()
+            upstream.stop()
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
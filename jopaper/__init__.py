@@ -1,4 +1,24 @@
-from .generator import Generator
-from .generator_service import Generators
+import importlib
+
+# Submodules are imported on first attribute access so that the CLI doesn't
+# pay for the server stack (pydantic-settings, FastAPI, OpenTelemetry) it
+# never uses.
+_lazy_attrs = {
+    "Generator": "jopaper.generator",
+    "Generators": "jopaper.generator_service",
+}
 
 __all__ = ["Generator", "Generators"]
+
+
+def __getattr__(name):
+    module = _lazy_attrs.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(module), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals().keys()) + __all__)
@@ -3,8 +3,6 @@ import argparse
 import os
 import tempfile
 
-from jopaper.generator import Generator
-
 
 class DirManager:
     def __init__(self, dirname=None):
@@ -59,11 +57,21 @@ def main():
         help='The path where the wallpaper will be saved. Default is "wallpaper.png"',
     )
 
+    parser.add_argument(
+        "--backend",
+        choices=["numpy", "pil"],
+        default="pil",
+        help="Compositing backend. Default is pil; numpy uses less memory.",
+    )
+
     args = parser.parse_args()
 
     logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARN)
     logger = logging.getLogger(__name__)
 
+    # Imported here so that argument parsing (e.g. --help) stays instant
+    from jopaper.generator import Generator
+
     with DirManager(args.dir) as dir:
         generator = Generator(
             download_dir=dir,
@@ -72,6 +80,7 @@ def main():
             screen_w=args.width,
             screen_h=args.height,
             logger=logger,
+            backend=args.backend,
         )
         wallpaper_filename = generator.get_next_wallpaper()
         # Write file content manually to support both file and pipe outputs
@@ -1,18 +1,36 @@
-from fastapi import FastAPI, Query
-from fastapi.responses import FileResponse, HTMLResponse, RedirectResponse
+from fastapi import FastAPI, HTTPException, Query
+from fastapi.responses import (
+    FileResponse,
+    HTMLResponse,
+    RedirectResponse,
+    Response,
+    StreamingResponse,
+)
+from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 from pydantic_settings import BaseSettings
+import asyncio
 import logging
+import os
 import uuid
+from urllib.parse import quote
 from jopaper import Generators
+from jopaper.generator import WallpaperStream
+from jopaper import debug
 from jopaper import tracing
-from typing import Annotated, Optional
+from typing import Annotated, List, Optional
 
 
 class Settings(BaseSettings):
     base_url: str = "localhost"
     screen_w_default: int = 1920
     screen_h_default: int = 1080
+    # Seconds to wait for a fresh wallpaper before serving a stale one;
+    # 0 waits indefinitely
+    wallpaper_deadline: float = 5.0
+    max_prefetch: int = 20
+    # Stream wallpapers that aren't ready yet while they are encoded
+    stream_wallpapers: bool = False
 
 
 settings = Settings()
@@ -21,10 +39,28 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
-generators = Generators(logger)
+generators = Generators(logger, max_prefetch=settings.max_prefetch)
 
 app = FastAPI(on_shutdown=[generators.stop])
 
+static_wallpaper_path = "/static/wallpaper"
+if generators.storage_backend.local:
+    os.makedirs(generators.wallpaper_root, exist_ok=True)
+    app.mount(
+        static_wallpaper_path,
+        StaticFiles(directory=generators.wallpaper_root),
+        name="static_wallpaper",
+    )
+else:
+
+    @app.get(static_wallpaper_path + "/{path:path}")
+    async def static_wallpaper(path: str):
+        if ".." in path.split("/"):
+            raise HTTPException(status_code=404)
+        return await _wallpaper_response(
+            os.path.join(generators.wallpaper_root, path), attachment=False
+        )
+
 
 @app.get("/wallpaper")
 async def wallpaper(
@@ -37,9 +73,77 @@ async def wallpaper(
     ] = settings.screen_h_default,
     r: Optional[str] = None,  # to make urls unique; ignore
 ):
-    generator = await generators.get_generator(screen_w, screen_h)
-    filename = await generator.aget_next_wallpaper(session_id)
-    return FileResponse(filename, filename="wallpaper.png")
+    get_wallpaper = (
+        generators.get_wallpaper_stream
+        if settings.stream_wallpapers
+        else generators.get_wallpaper
+    )
+    wallpaper = await get_wallpaper(
+        screen_w,
+        screen_h,
+        session_id,
+        timeout=settings.wallpaper_deadline or None,
+    )
+    if isinstance(wallpaper, WallpaperStream):
+        return StreamingResponse(
+            wallpaper.iter_chunks(),
+            media_type="image/png",
+            headers={"Content-Disposition": 'attachment; filename="wallpaper.png"'},
+        )
+    return await _wallpaper_response(wallpaper)
+
+
+async def _wallpaper_response(filename, attachment=True):
+    backend = generators.storage_backend
+    if backend.local:
+        return FileResponse(filename, filename="wallpaper.png" if attachment else None)
+    try:
+        content = await asyncio.to_thread(backend.read, filename)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404) from None
+    headers = {}
+    if attachment:
+        headers["Content-Disposition"] = 'attachment; filename="wallpaper.png"'
+    return Response(content, media_type="image/png", headers=headers)
+
+
+class WallpapersResponse(BaseModel):
+    urls: List[str]
+
+
+# Prefetch a batch of wallpapers for slideshows
+@app.get("/wallpapers")
+async def wallpapers(
+    session_id: Optional[str] = None,
+    screen_w: Annotated[
+        int, Query(title="Screen width", ge=100, le=8000)
+    ] = settings.screen_w_default,
+    screen_h: Annotated[
+        int, Query(title="Screen height", ge=100, le=8000)
+    ] = settings.screen_h_default,
+    count: Annotated[
+        int, Query(title="Number of wallpapers", ge=1, le=settings.max_prefetch)
+    ] = 5,
+) -> WallpapersResponse:
+    filenames = await generators.get_wallpapers(
+        screen_w,
+        screen_h,
+        session_id,
+        count,
+        timeout=settings.wallpaper_deadline or None,
+    )
+    return WallpapersResponse(urls=[_static_url(f) for f in filenames])
+
+
+def _static_url(filename):
+    path = os.path.relpath(filename, generators.wallpaper_root)
+    return "/".join([static_wallpaper_path, quote(path)])
+
+
+# Render budget and worker load, for monitoring
+@app.get("/status")
+async def status() -> dict:
+    return generators.get_status()
 
 
 # JSON endpoint for RandomWallpaperGnome3 extension
@@ -66,3 +170,4 @@ async def index(session_id: Optional[str] = None) -> HTMLResponse:
 
 
 tracing.setup_tracer(app, generators)
+debug.setup_debug(app, generators)
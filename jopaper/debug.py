@@ -0,0 +1,132 @@
+import asyncio
+import collections
+import concurrent.futures
+import sys
+import threading
+import time
+import tracemalloc
+from fastapi import APIRouter, Query
+from pydantic_settings import BaseSettings
+from typing import Annotated
+import logging
+
+
+class Settings(BaseSettings):
+    debug_endpoints: bool = False
+
+
+settings = Settings()
+
+# The profiler gets its own thread so it doesn't take a worker from the
+# default executor it is profiling
+_profiler_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=1, thread_name_prefix="profiler"
+)
+
+
+def sample_profile(seconds: float, interval: float = 0.005, top: int = 30):
+    """
+    Sample the stacks of all threads but the calling one for @seconds.
+    Return the functions seen most often, on top of the stack (self) and
+    anywhere in it (total), and the number of samples per thread.
+    """
+    own_id = threading.get_ident()
+    names = {t.ident: t.name for t in threading.enumerate()}
+    self_counts = collections.Counter()
+    total_counts = collections.Counter()
+    thread_counts = collections.Counter()
+    samples = 0
+
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for ident, frame in sys._current_frames().items():
+            if ident == own_id:
+                continue
+            if ident not in names:
+                names = {t.ident: t.name for t in threading.enumerate()}
+            thread_counts[names.get(ident, str(ident))] += 1
+            self_counts[_frame_key(frame)] += 1
+            seen = set()
+            while frame is not None:
+                key = _frame_key(frame)
+                if key not in seen:
+                    seen.add(key)
+                    total_counts[key] += 1
+                frame = frame.f_back
+        samples += 1
+        time.sleep(interval)
+
+    return {
+        "seconds": seconds,
+        "samples": samples,
+        "threads": dict(thread_counts.most_common()),
+        "top": [
+            {"function": key, "self": self_counts[key], "total": count}
+            for key, count in total_counts.most_common(top)
+        ],
+        "top_self": [
+            {"function": key, "self": count, "total": total_counts[key]}
+            for key, count in self_counts.most_common(top)
+        ],
+    }
+
+
+def memory_snapshot(top: int = 30):
+    """
+    Return the biggest allocation sites since tracing started
+    """
+    snapshot = tracemalloc.take_snapshot()
+    snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+    current, peak = tracemalloc.get_traced_memory()
+    return {
+        "traced_current": current,
+        "traced_peak": peak,
+        "top": [
+            {"location": str(stat.traceback), "size": stat.size, "count": stat.count}
+            for stat in snapshot.statistics("lineno")[:top]
+        ],
+    }
+
+
+def _frame_key(frame):
+    code = frame.f_code
+    return f"{code.co_filename}:{code.co_firstlineno}({code.co_name})"
+
+
+def setup_debug(fastapi_app, generators):
+    if not settings.debug_endpoints:
+        return
+    logging.warning("Debug endpoints are enabled")
+
+    router = APIRouter(prefix="/debug")
+
+    @router.get("/profile")
+    async def profile(
+        seconds: Annotated[float, Query(gt=0, le=60)] = 5.0,
+        top: Annotated[int, Query(ge=1, le=200)] = 30,
+    ):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            _profiler_executor, sample_profile, seconds, 0.005, top
+        )
+
+    @router.get("/memory")
+    async def memory(
+        top: Annotated[int, Query(ge=1, le=200)] = 30,
+        stop: bool = False,
+    ):
+        if stop:
+            tracemalloc.stop()
+            return {"tracing": False}
+        if not tracemalloc.is_tracing():
+            # Only allocations made from now on are traced
+            tracemalloc.start()
+            return {"tracing": True}
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_profiler_executor, memory_snapshot, top)
+
+    @router.get("/generators")
+    async def generators_state():
+        return await generators.get_state()
+
+    fastapi_app.include_router(router)
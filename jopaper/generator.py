@@ -1,11 +1,25 @@
 from jopaper import reactor
 from jopaper.storage import Storage
-from jopaper.layout import SubImage, Wall
+from jopaper.storage_backends import StorageBackend
+from jopaper.layout import SubImage, Wall, rescale
+from jopaper.scheduler import (
+    PRIORITY_EMPTY,
+    PRIORITY_INTERACTIVE,
+    PRIORITY_REFILL,
+    RenderBudget,
+)
 from PIL import Image
 import random
 from typing import List
 import asyncio
+import contextlib
 import functools
+import threading
+import time
+from collections import OrderedDict, deque
+
+# Supported layouts: a single picture or a row of pictures
+_layout_columns = (1, 4)
 
 
 class LogTracer:
@@ -38,20 +52,20 @@ class LogTracer:
 
 
 class Cache:
-    def __init__(self, logger):
+    def __init__(self, logger, max_session_number: int = 1000):
         self.logger = logger
         self.lock = asyncio.Lock()
         # Items count should be about 10 so list is fine
         self.items = []
         self.sessions = []
-        self.max_session_number = 1000
+        self.max_session_number = max_session_number
         self.session_last_items = {}
         self.epoch = 0
 
     async def add(self, item, session_id):
         async with self.lock:
             self.items.append(item)
-            self.session_last_items[session_id] = self.epoch + len(self.items)
+            self.session_last_items[session_id] = self.epoch + len(self.items) - 1
 
     async def remove(self, item):
         async with self.lock:
@@ -64,35 +78,210 @@ class Cache:
                 )
 
     async def get(self, session_id):
+        items = await self.get_many(session_id, 1)
+        return items[0] if items else None
+
+    async def get_many(self, session_id, count):
+        """
+        Return up to @count items following the session's last one and
+        advance the session past them
+        """
         async with self.lock:
             last_item = self.session_last_items.get(session_id)
             if last_item is None or last_item < self.epoch:
                 current_item = self.epoch
             else:
                 current_item = last_item + 1
-            if (
-                current_item >= self.epoch + len(self.items)
-                or current_item < self.epoch
-            ):
-                return None
-            self.session_last_items[session_id] = current_item
+            end_item = min(current_item + count, self.epoch + len(self.items))
+            if current_item >= end_item or current_item < self.epoch:
+                return []
+            self.session_last_items[session_id] = end_item - 1
 
             if len(self.session_last_items) > self.max_session_number:
                 await self._pop_sessions()
-            return self.items[current_item - self.epoch]
+            return self.items[current_item - self.epoch : end_item - self.epoch]
+
+    async def get_state(self):
+        async with self.lock:
+            return {
+                "items": len(self.items),
+                "sessions": len(self.session_last_items),
+                "epoch": self.epoch,
+            }
+
+    async def latest(self):
+        async with self.lock:
+            return self.items[-1] if self.items else None
 
     async def _pop_sessions(self):
-        rev = ((last, session) for last, session in self.session_last_items.items())
-        rem = [session for last, session in rev if last < self.epoch]
+        sessions = self.session_last_items
+        rem = [session for session, last in sessions.items() if last < self.epoch]
         # If all sessions are up to date, remove the oldest 10%
         if not rem:
-            rev = sorted(rev, key=lambda ls: ls[1])
-            rem = [session for last, session in rev[: self.max_session_number / 10]]
+            by_last = sorted(sessions.items(), key=lambda sl: sl[1])
+            rem = [
+                session for session, last in by_last[: self.max_session_number // 10]
+            ]
 
         for session in rem:
             del self.session_last_items[session]
 
 
+class CandidatePool:
+    """
+    Bounded set of downloaded images waiting to be laid out, bucketed by
+    the number of columns they suit so a layout never rescans everything.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        # Per bucket, filename -> SubImage in insertion order
+        self.buckets = {}
+
+    def __len__(self):
+        return sum(len(b) for b in self.buckets.values())
+
+    def add(self, bucket, image: SubImage) -> List[SubImage]:
+        """
+        Add an image and return the ones evicted to stay within the bound
+        """
+        self.buckets.setdefault(bucket, OrderedDict())[image.filename] = image
+        evicted = []
+        while len(self) > self.max_size:
+            # The oldest image of the most crowded bucket is the least useful
+            largest = max(self.buckets.values(), key=len)
+            evicted.append(largest.popitem(last=False)[1])
+        return evicted
+
+    def get_state(self):
+        # Called from the event loop while the feed may add from a worker
+        return {bucket: len(images) for bucket, images in list(self.buckets.items())}
+
+    def take(self, bucket, count) -> List[SubImage]:
+        """
+        Remove and return @count random images from the bucket, or None
+        if there are not enough of them
+        """
+        images = self.buckets.get(bucket)
+        if not images or len(images) < count:
+            return None
+        taken = random.sample(list(images.keys()), count)
+        return [images.pop(f) for f in taken]
+
+
+class WallpaperStream:
+    """
+    Hands the chunks of a wallpaper encoded in a worker thread over to the
+    event loop as they are written to storage. The encoder waits a little
+    for a slow client instead of buffering the wallpaper, and stops
+    feeding the stream once the client is gone or has cost it max_stall
+    seconds; a render worker is never held by a client for longer.
+    """
+
+    _done = object()
+    # Chunks buffered between the encoder and the client
+    max_chunks = 8
+    # Seconds the encoder may wait for the client in all
+    max_stall = 5.0
+
+    def __init__(self, session_id, loop):
+        self.session_id = session_id
+        self.loop = loop
+        self.chunks = asyncio.Queue(maxsize=self.max_chunks)
+        # Free places in chunks, taken by the encoder before putting
+        self.room = threading.Semaphore(self.max_chunks)
+        self.started = asyncio.Event()
+        self.lock = threading.Lock()
+        self.claimed = False
+        self.cancelled = False
+        self.abandoned = False
+        # Seconds the encoder has waited for the client so far
+        self.stalled = 0.0
+
+    def claim(self) -> bool:
+        """
+        Called by the render that will produce the stream
+        """
+        with self.lock:
+            if self.cancelled:
+                return False
+            self.claimed = True
+        self.loop.call_soon_threadsafe(self.started.set)
+        return True
+
+    def cancel(self) -> bool:
+        """
+        Give up on the stream; False if a render has already claimed it
+        """
+        with self.lock:
+            if self.claimed:
+                return False
+            self.cancelled = True
+            return True
+
+    def writer(self, out):
+        return _StreamWriter(out, self)
+
+    def put(self, chunk):
+        """
+        Called from the worker thread; blocks until the client has room
+        or the stall budget is spent
+        """
+        if self.abandoned:
+            return
+        start = time.monotonic()
+        has_room = self.room.acquire(timeout=max(self.max_stall - self.stalled, 0))
+        self.stalled += time.monotonic() - start
+        if not has_room:
+            self.abandoned = True
+            # The client gets what is queued, then an error
+            self.loop.call_soon_threadsafe(self.chunks.shutdown)
+            return
+        if not self.abandoned:
+            self.loop.call_soon_threadsafe(self._put_nowait, chunk)
+
+    def _put_nowait(self, chunk):
+        with contextlib.suppress(asyncio.QueueShutDown):
+            self.chunks.put_nowait(chunk)
+
+    def close(self, error: Exception = None):
+        self.put(error if error is not None else self._done)
+
+    async def iter_chunks(self):
+        try:
+            while True:
+                try:
+                    chunk = await self.chunks.get()
+                except asyncio.QueueShutDown:
+                    raise RuntimeError("Wallpaper stream stalled") from None
+                self.room.release()
+                if chunk is self._done:
+                    return
+                if isinstance(chunk, Exception):
+                    raise chunk
+                yield chunk
+        finally:
+            # Done, or the client went away: the encoder only writes storage
+            self.abandoned = True
+            self.chunks.shutdown(immediate=True)
+            self.room.release()
+
+
+class _StreamWriter:
+    # No fileno() on purpose: PIL then encodes through write()
+    def __init__(self, out, stream: WallpaperStream):
+        self.out = out
+        self.stream = stream
+
+    def write(self, data):
+        written = self.out.write(data)
+        self.stream.put(bytes(data))
+        return written
+
+    def flush(self):
+        self.out.flush()
+
+
 class Generator:
     def __init__(
         self,
@@ -105,19 +294,59 @@ class Generator:
         max_images: int = None,
         is_async: bool = False,
         tracer=None,
+        max_used_cnt: int = 20,
+        max_wallpaper_cnt: int = 20,
+        source: reactor.Source = None,
+        max_candidates: int = 50,
+        seen_horizon: int = 10000,
+        render_budget: RenderBudget = None,
+        schedulers: dict = None,
+        backend: str = "pil",
+        storage_backend: StorageBackend = None,
+        max_sessions: int = 1000,
     ):
         self.screen_w = screen_w
         self.screen_h = screen_h
         self.logger = logger
-        filters = reactor.get_default_filters(screen_w, screen_h)
-        self.source = reactor.Source(logger, filters)
-        self.storage = Storage(download_dir, used_dir, wallpaper_dir, logger)
+        self.source = source if source is not None else reactor.Source(logger)
+        self.source.subscribe(
+            self._key(), reactor.get_default_constraints(screen_w, screen_h)
+        )
+        self.storage = Storage(
+            download_dir,
+            used_dir,
+            wallpaper_dir,
+            logger,
+            max_used_cnt=max_used_cnt,
+            max_wallpaper_cnt=max_wallpaper_cnt,
+            seen_horizon=seen_horizon,
+            backend=storage_backend,
+        )
         self.is_async = is_async
         self.tracer = tracer if tracer is not None else LogTracer(self.logger)
+        # Work kind ("download", "render") -> WorkScheduler
+        self.schedulers = schedulers if schedulers is not None else {}
+        self.waiting = 0
+        self.backend = backend
+        # Streams waiting for the next render, oldest first
+        self.stream_requests = deque()
+        # The rescale of another resolution's wallpaper in progress
+        self.adopting = None
+        self.adopt_waiters = 0
+        # Streamed wallpaper filename -> session it was streamed to
+        self.streamed = {}
+        # Rendered wallpapers not served yet; they don't count as old
+        self.unserved = set()
+        self.candidates = CandidatePool(max_candidates)
+        self.downloaded = 0
+        self.rendered = 0
+        self.render_budget = (
+            render_budget if render_budget is not None else RenderBudget()
+        )
         self.feed = self._wallpaper_feed()
         if self.is_async:
             self.wallpapers_queue = asyncio.Queue(maxsize=max_images)
-            self.cache = Cache(self.logger)
+            self.cache = Cache(self.logger, max_sessions)
         self.logger.debug(f"Created new generator: {vars(self)}")
 
     async def start(self):
@@ -125,52 +354,210 @@ class Generator:
         self.logger.debug(f"Starting generator {self.screen_w}x{self.screen_h}")
         try:
             async for wallpaper in self.feed:
+                if wallpaper in self.streamed:
+                    # Already sent to the client that requested the stream
+                    session_id = self.streamed.pop(wallpaper)
+                    await self._cache_wallpaper(wallpaper, session_id)
+                    continue
                 self.logger.debug(f"Saving wallpaper [{wallpaper}] to queue")
+                self.unserved.add(wallpaper)
                 await self.wallpapers_queue.put(wallpaper)
         except asyncio.QueueShutDown:
             pass
 
     async def stop(self):
         assert self.is_async
+        self.source.unsubscribe(self._key())
         self.wallpapers_queue.shutdown(immediate=True)
+        # Waiters on the queue get QueueShutDown, those on a stream likewise
+        while self.stream_requests:
+            stream = self.stream_requests.popleft()
+            if stream.cancel():
+                stream.started.set()
 
     def get_next_wallpaper(self) -> str:
         assert not self.is_async
         return asyncio.run(anext(self.feed))
 
-    async def aget_next_wallpaper(self, session_id: str) -> str:
+    async def aget_next_wallpaper(self, session_id: str, timeout: float = None) -> str:
+        """
+        Raise TimeoutError if no wallpaper is ready within @timeout seconds;
+        rendering carries on in the background.
+        """
         assert self.is_async
         wallpaper = None
         if not self.wallpapers_queue.full():
             wallpaper = await self.cache.get(session_id)
         if wallpaper is None:
-            wallpaper = await self.wallpapers_queue.get()
+            self.waiting += 1
+            try:
+                wallpaper = await asyncio.wait_for(self.wallpapers_queue.get(), timeout)
+            finally:
+                self.waiting -= 1
             self.wallpapers_queue.task_done()
+            await self._cache_wallpaper(wallpaper, session_id)
+        return wallpaper
 
-            old_wallpapers = self.storage.get_old_wallpapers()
-            for item in old_wallpapers:
-                await self.cache.remove(item)
-            self.storage.rm_wallpapers(old_wallpapers)
-            await self.cache.add(wallpaper, session_id)
+    async def aget_wallpaper_stream(self, session_id: str, timeout: float = None):
+        """
+        Return the filename of a ready wallpaper, or a WallpaperStream of
+        the next render. Raise TimeoutError if that render doesn't start
+        encoding within @timeout seconds.
+        """
+        assert self.is_async
+        wallpapers = await self.aget_next_wallpapers(session_id, 1)
+        if wallpapers:
+            return wallpapers[0]
+
+        stream = WallpaperStream(session_id, asyncio.get_running_loop())
+        self.stream_requests.append(stream)
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(stream.started.wait(), timeout)
+        except TimeoutError:
+            if stream.cancel():
+                raise
+            # Claimed just in time
+        except asyncio.CancelledError:
+            stream.cancel()
+            raise
+        finally:
+            self.waiting -= 1
+        if stream.cancelled:
+            # The generator stopped before a render claimed the stream
+            raise asyncio.QueueShutDown
+        return stream
+
+    async def aget_next_wallpapers(self, session_id: str, count: int) -> List[str]:
+        """
+        Return up to @count wallpapers the session hasn't seen yet without
+        waiting for new ones to be rendered
+        """
+        assert self.is_async
+        wallpapers = await self.cache.get_many(session_id, count)
+        while len(wallpapers) < count:
+            try:
+                wallpaper = self.wallpapers_queue.get_nowait()
+            except asyncio.QueueEmpty:
+                break
+            self.wallpapers_queue.task_done()
+            await self._cache_wallpaper(wallpaper, session_id)
+            wallpapers.append(wallpaper)
+        return wallpapers
+
+    async def aget_latest_wallpaper(self) -> str:
+        """
+        Return the most recently served wallpaper, or None
+        """
+        assert self.is_async
+        return await self.cache.latest()
+
+    async def aadopt_wallpaper(self, filename: str, session_id: str) -> str:
+        """
+        Rescale a wallpaper of another resolution to this one. Concurrent
+        callers share one rescale, which is dropped once none of them is
+        waiting for it anymore.
+        """
+        assert self.is_async
+        if self.adopting is None or self.adopting.done():
+            self.adopting = asyncio.create_task(self._adopt(filename, session_id))
+        adopting = self.adopting
+        self.adopt_waiters += 1
+        # Keeps the fresh render as urgent as the rescale
+        self.waiting += 1
+        try:
+            return await asyncio.shield(adopting)
+        finally:
+            self.waiting -= 1
+            self.adopt_waiters -= 1
+            if not self.adopt_waiters:
+                adopting.cancel()
+
+    async def _adopt(self, filename, session_id):
+        @self.tracer.start_as_current_span("adopt_wallpaper")
+        def f():
+            # Source, scaled canvas and its encoded copy
+            with self.render_budget.reserve(
+                3 * self.screen_w * self.screen_h, self.get_priority
+            ):
+                image = rescale(
+                    self.storage.get_source(filename), self.screen_w, self.screen_h
+                )
+                return self.storage.save_wallpaper(image)
+
+        # No more urgent than the fresh render the requests wait for too
+        wallpaper = await self._run_bg(f, "render")
+        await self.cache.add(wallpaper, session_id)
         return wallpaper
 
-    async def _run_bg(self, f):
-        loop = asyncio.get_running_loop()
-        return await loop.run_in_executor(None, f)
+    async def get_state(self) -> dict:
+        assert self.is_async
+        return {
+            "queue_size": self.wallpapers_queue.qsize(),
+            "queue_max_size": self.wallpapers_queue.maxsize,
+            "candidates": self.candidates.get_state(),
+            "source_cached": self.source.get_cached_count(self._key()),
+            "cache": await self.cache.get_state(),
+            "downloads": len(self.storage.downloads),
+            "downloaded": self.downloaded,
+            "rendered": self.rendered,
+            "seen": len(self.storage.seen),
+        }
+
+    async def _cache_wallpaper(self, wallpaper, session_id):
+        self.unserved.discard(wallpaper)
+        old_wallpapers = self.storage.pop_old_wallpapers(exclude=self.unserved)
+        for item in old_wallpapers:
+            await self.cache.remove(item)
+        if old_wallpapers:
+            await asyncio.to_thread(self.storage.rm_wallpapers, old_wallpapers)
+        await self.cache.add(wallpaper, session_id)
+
+    def _claim_stream(self):
+        while True:
+            try:
+                stream = self.stream_requests.popleft()
+            except IndexError:
+                return None
+            if stream.claim():
+                return stream
+
+    def _key(self):
+        return self.screen_w, self.screen_h
+
+    def get_priority(self):
+        if self.waiting:
+            return PRIORITY_INTERACTIVE
+        if self.wallpapers_queue.empty():
+            return PRIORITY_EMPTY
+        return PRIORITY_REFILL
+
+    async def _run_bg(self, f, kind, priority=None):
+        scheduler = self.schedulers.get(kind)
+        if scheduler is None:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, f)
+        return await scheduler.run(
+            f, priority if priority is not None else self.get_priority
+        )
 
     async def _download_random_image(self):
         @self.tracer.start_as_current_span("download_random_image")
         def f():
-            image = self.source.get_image()
+            image = self.source.get_image(self._key(), self._demand())
+            if self.storage.is_seen(image.url):
+                self.logger.debug(f"Skipping already seen image {image.url}")
+                return None
             try:
                 fname = self.storage.download_file(image.url, image.file_type)
             except Exception as e:
                 self.logger.error(f"Error downloading {image.url}: [{e}]")
                 return None
             self.logger.info(f"Image {image.url} successfully saved to {fname}")
+            self.downloaded += 1
             return fname
 
-        return await self._run_bg(f)
+        return await self._run_bg(f, "download")
 
     async def _random_file_feed(self):
         filenames = self.storage.get_downloads()
@@ -181,39 +568,56 @@ class Generator:
             if filename:
                 yield filename
 
-    def _gen_random_wall(self, images: List[SubImage]):
-        random.shuffle(images)
-        wall = Wall(self.screen_w, self.screen_h)
-        layout = []
-        ratio1 = self.screen_w / self.screen_h
-        ratio4 = self.screen_w / 4 / self.screen_h
-        layout_matched = False
-
-        for image in images:
-            ratio = image.get_ratio()
-            f1 = abs(ratio - ratio1)
-            f4 = abs(ratio - ratio4)
-            if f1 < f4:
-                # Go for single picture
-                image.to_box(0, 0, self.screen_w, self.screen_h)
-                layout = [image]
-                layout_matched = True
+    def _columns(self, image: SubImage):
+        """
+        Return the number of columns of the layout the image suits best
+        """
+        ratio = image.get_ratio()
+        return min(
+            _layout_columns,
+            key=lambda c: abs(ratio - self.screen_w / c / self.screen_h),
+        )
+
+    def _demand(self) -> List[reactor.Constraints]:
+        """
+        Constraints of images that would complete the started layouts, the
+        closest to completion first, or None if no layout is started
+        """
+        filled = self.candidates.get_state()
+        started = [c for c in _layout_columns if 0 < filled.get(c, 0) < c]
+        demand = []
+        for columns in sorted(started, key=lambda c: c - filled[c]):
+            slot_w = self.screen_w / columns
+            ratios = [slot_w / self.screen_h]
+            # Prefer images filling the slot without upscaling
+            demand.append(
+                reactor.Constraints(
+                    min_width=slot_w, min_height=self.screen_h, ratios=ratios
+                )
+            )
+            demand.append(
+                reactor.Constraints(
+                    min_width=self.screen_w / 4,
+                    min_height=self.screen_h / 2,
+                    ratios=ratios,
+                )
+            )
+        return demand or None
+
+    def _gen_random_wall(self):
+        for columns in _layout_columns:
+            layout = self.candidates.take(columns, columns)
+            if layout:
                 break
-            else:
-                # Go for 4 in row
-                image.to_box(0, 0, self.screen_w / 4, self.screen_h)
-                layout.append(image)
-                if len(layout) == 4:
-                    layout_matched = True
-                    break
-        if not layout_matched:
+        else:
             return None
+        wall = Wall(self.screen_w, self.screen_h, backend=self.backend)
         for image in layout:
+            image.to_box(0, 0, self.screen_w / columns, self.screen_h)
             wall.add(image)
         return wall
 
     async def _wallpaper_feed(self):
-        images = {}
         async for filename in self._random_file_feed():
 
             @self.tracer.start_as_current_span("generate_wallpaper")
@@ -222,28 +626,44 @@ class Generator:
                     p = self._parse_image(filename)
                 if p is None:
                     return None
-                images[filename] = p
+                for evicted in self.candidates.add(self._columns(p), p):
+                    self.logger.debug(f"Evicting candidate {evicted.filename}")
+                    self.storage.rm_download(evicted.filename)
                 with self.tracer.start_as_current_span("generate_layout"):
-                    wall = self._gen_random_wall(list(images.values()))
+                    wall = self._gen_random_wall()
                 if wall is None:
                     return None
-                used_files, image = wall.get_png(tracer=self.tracer)
-                with self.tracer.start_as_current_span("save_wallpaper"):
-                    wallpaper_filename = self.storage.save_wallpaper(image)
+                with self.render_budget.reserve(wall.get_cost(), self.get_priority):
+                    stream = self._claim_stream()
+                    try:
+                        with self.storage.wallpaper_writer() as (
+                            wallpaper_filename,
+                            out,
+                        ):
+                            if stream is not None:
+                                out = stream.writer(out)
+                            used_files = wall.write_png(out, tracer=self.tracer)
+                    except Exception as e:
+                        if stream is not None:
+                            stream.close(e)
+                        raise
+                if stream is not None:
+                    self.streamed[wallpaper_filename] = stream.session_id
+                    stream.close()
                 for f in used_files:
-                    del images[f]
                     self.storage.mark_used(f)
+                self.rendered += 1
                 return wallpaper_filename
 
-            wallpaper_filename = await self._run_bg(f)
+            wallpaper_filename = await self._run_bg(f, "render")
             if wallpaper_filename:
                 yield wallpaper_filename
 
     def _parse_image(self, f):
         try:
-            with Image.open(f) as img:
+            with Image.open(self.storage.get_source(f)) as img:
                 w, h = img.size
         except Exception:
             self.logger.error(f"Can't parse an image: {f}", exc_info=True)
             return None
-        return SubImage(f, w, h)
+        return SubImage(f, w, h, opener=self.storage.get_source)
@@ -1,21 +1,55 @@
 from pydantic_settings import BaseSettings
 import asyncio
 from jopaper import Generator
+from jopaper import reactor
+from jopaper.scheduler import RenderBudget, WorkScheduler
+from jopaper.storage_backends import LocalBackend, MemoryBackend, S3Backend
+import math
 import os
+import socket
+from typing import List
 
 
 class Settings(BaseSettings):
     max_generators: int = 100
     max_images_per_generator: int = 10
+    # Sessions each generator remembers what it served to
+    max_sessions_per_generator: int = 1000
+    max_candidates_per_generator: int = 50
+    seen_horizon: int = 10000
+    # Megapixels all concurrent renders may hold in memory at once
+    render_budget_mpx: float = 200
+    download_workers: int = 8
+    # Wall compositing backend, see layout.Wall
+    compositing_backend: str = "pil"
+    render_workers: int = os.cpu_count() or 1
+    max_used_cnt: int = 20
+    max_wallpaper_cnt: int = 20
     fs_root: str = "./storage"
+    # Where files are kept: "local" (under fs_root), "memory" or "s3"
+    storage_backend: str = "local"
+    # Hosts sharing a bucket keep their files under their own instance name
+    storage_instance: str = socket.gethostname()
+    s3_endpoint_url: str = "https://s3.amazonaws.com"
+    s3_bucket: str = "jopaper"
+    s3_prefix: str = ""
+    s3_region: str = "us-east-1"
+    s3_access_key: str = ""
+    s3_secret_key: str = ""
 
 
 settings = Settings()
 
 
 class Generators:
-    def __init__(self, logger):
+    def __init__(self, logger, max_prefetch: int = 0):
         self.logger = logger
+        # Served wallpapers are kept long enough for a prefetched batch to
+        # outlive another queue of renders being served
+        self.max_wallpaper_cnt = max(
+            settings.max_wallpaper_cnt,
+            max_prefetch + settings.max_images_per_generator,
+        )
 
         self.lock = asyncio.Lock()
         self.generators = {}
@@ -26,6 +60,20 @@ class Generators:
 
         self.tasks = {}
 
+        self.storage_backend = _create_storage_backend()
+        # Keys of other backends are relative to their own root
+        self.storage_root = settings.fs_root if self.storage_backend.local else ""
+        self.wallpaper_root = os.path.join(self.storage_root, "wallpaper")
+
+        # Shared by all generators so one upstream page feeds every resolution
+        self.source = reactor.Source(logger)
+        self.render_budget = RenderBudget(int(settings.render_budget_mpx * 1e6))
+        # Download and render work of all generators, most urgent first
+        self.schedulers = {
+            "download": WorkScheduler("download", settings.download_workers, logger),
+            "render": WorkScheduler("render", settings.render_workers, logger),
+        }
+
         self.tracer = None
 
     def set_tracer(self, tracer):
@@ -39,9 +87,10 @@ class Generators:
                 return self.generators[key]
             if len(self.generators) >= self.max_generators:
                 gens = _sort_k_by_v_join(self.generators, self.usage)
-                gen_to_remove = gens[: -self.max_generators]
+                # Make room for the new one
+                gen_to_remove = gens[: len(gens) - self.max_generators + 1]
                 for gen in gen_to_remove:
-                    self._remove_generator(gen)
+                    await self._remove_generator(gen)
             if len(self.usage) > self.max_usage:
                 usage_to_remove = _sort_k_by_v(self.usage)[: -self.max_usage]
                 for u in usage_to_remove:
@@ -51,46 +100,223 @@ class Generators:
             self.generators[key] = new_gen
         return new_gen
 
+    async def get_wallpaper(
+        self, screen_w: int, screen_h: int, session_id: str, timeout: float = None
+    ) -> str:
+        """
+        Return the next wallpaper, or a stale one if a fresh one isn't
+        ready within @timeout seconds: the most recent one of the same
+        resolution, or one of the nearest resolution rescaled unless a
+        fresh one comes first.
+        """
+
+        async def f(generator):
+            try:
+                return await generator.aget_next_wallpaper(session_id, timeout=timeout)
+            except TimeoutError:
+                self.logger.debug(f"No fresh wallpaper {screen_w}x{screen_h} in time")
+            return await self._stale_wallpaper(generator, session_id)
+
+        return await self._with_generator(screen_w, screen_h, f)
+
+    async def get_wallpaper_stream(
+        self, screen_w: int, screen_h: int, session_id: str, timeout: float = None
+    ):
+        """
+        Like get_wallpaper, but if no wallpaper is ready return a
+        WallpaperStream of the next render as it is encoded
+        """
+
+        async def f(generator):
+            try:
+                return await generator.aget_wallpaper_stream(
+                    session_id, timeout=timeout
+                )
+            except TimeoutError:
+                self.logger.debug(f"No wallpaper {screen_w}x{screen_h} stream in time")
+            return await self._stale_wallpaper(generator, session_id)
+
+        return await self._with_generator(screen_w, screen_h, f)
+
+    async def _with_generator(self, screen_w: int, screen_h: int, f):
+        """
+        Await f(generator), over again with a new generator if the one it
+        got is removed meanwhile
+        """
+        while True:
+            generator = await self.get_generator(screen_w, screen_h)
+            try:
+                return await f(generator)
+            except asyncio.QueueShutDown:
+                self.logger.debug(f"Generator {screen_w}x{screen_h} removed, retry")
+
+    async def _stale_wallpaper(self, generator, session_id: str) -> str:
+        screen_w, screen_h = generator.screen_w, generator.screen_h
+        wallpaper = await generator.aget_latest_wallpaper()
+        if wallpaper is not None:
+            return wallpaper
+        nearest = await self._nearest_wallpaper(screen_w, screen_h)
+        if nearest is not None:
+            self.logger.debug(f"Rescaling [{nearest}] to {screen_w}x{screen_h}")
+            # Whichever is ready first: the rescale, or a fresh one after all
+            adopted = asyncio.create_task(
+                generator.aadopt_wallpaper(nearest, session_id)
+            )
+            fresh = asyncio.create_task(generator.aget_next_wallpaper(session_id))
+            try:
+                done, _ = await asyncio.wait(
+                    (adopted, fresh), return_when=asyncio.FIRST_COMPLETED
+                )
+                return await done.pop()
+            finally:
+                adopted.cancel()
+                fresh.cancel()
+        return await generator.aget_next_wallpaper(session_id)
+
+    async def get_wallpapers(
+        self,
+        screen_w: int,
+        screen_h: int,
+        session_id: str,
+        count: int,
+        timeout: float = None,
+    ) -> List[str]:
+        """
+        Return up to @count wallpapers for the session at once; waits as
+        get_wallpaper does only if none are ready.
+        """
+        wallpapers = await self._with_generator(
+            screen_w,
+            screen_h,
+            lambda generator: generator.aget_next_wallpapers(session_id, count),
+        )
+        if not wallpapers:
+            wallpapers = [
+                await self.get_wallpaper(screen_w, screen_h, session_id, timeout)
+            ]
+        return wallpapers
+
+    async def _nearest_wallpaper(self, screen_w: int, screen_h: int):
+        """
+        Return the latest wallpaper of the resolution closest by aspect
+        ratio and then by size, or None
+        """
+
+        def distance(key):
+            w, h = key
+            return (
+                abs(math.log((w / h) / (screen_w / screen_h))),
+                abs(math.log((w * h) / (screen_w * screen_h))),
+            )
+
+        async with self.lock:
+            candidates = [
+                (key, gen)
+                for key, gen in self.generators.items()
+                if key != (screen_w, screen_h)
+            ]
+        for key, gen in sorted(candidates, key=lambda kg: distance(kg[0])):
+            wallpaper = await gen.aget_latest_wallpaper()
+            if wallpaper is not None:
+                return wallpaper
+        return None
+
+    async def get_state(self) -> dict:
+        async with self.lock:
+            generators = list(self.generators.items())
+            usage = dict(self.usage)
+        return {
+            "generators": {
+                f"{w}x{h}": {"usage": usage.get((w, h), 0), **await gen.get_state()}
+                for (w, h), gen in generators
+            },
+            "max_generators": self.max_generators,
+            **self.get_status(),
+        }
+
+    def get_status(self) -> dict:
+        """
+        Server-wide load: render budget usage and work waiting for workers
+        """
+        return {
+            "render_budget": self.render_budget.get_state(),
+            "schedulers": {k: s.get_state() for k, s in self.schedulers.items()},
+        }
+
     async def stop(self):
         self.logger.debug("Stopping generators")
         for key in list(self.generators.keys()):
-            self._remove_generator(key)
+            await self._remove_generator(key)
+        for scheduler in self.schedulers.values():
+            scheduler.stop()
 
     async def _new_generator(self, screen_w, screen_h):
-        new_gen = Generator(
-            download_dir=os.path.join(
-                settings.fs_root, "download", f"{screen_w}x{screen_h}"
-            ),
-            used_dir=os.path.join(settings.fs_root, "used", f"{screen_w}x{screen_h}"),
-            wallpaper_dir=os.path.join(
-                settings.fs_root, "wallpaper", f"{screen_w}x{screen_h}"
-            ),
+        # Its storage lists what the backend already holds
+        new_gen = await asyncio.to_thread(
+            Generator,
+            download_dir=self._storage_dir("download", screen_w, screen_h),
+            used_dir=self._storage_dir("used", screen_w, screen_h),
+            wallpaper_dir=self._storage_dir("wallpaper", screen_w, screen_h),
             screen_w=screen_w,
             screen_h=screen_h,
             max_images=settings.max_images_per_generator,
             logger=self.logger,
             is_async=True,
             tracer=self.tracer,
+            max_used_cnt=settings.max_used_cnt,
+            max_wallpaper_cnt=self.max_wallpaper_cnt,
+            source=self.source,
+            max_candidates=settings.max_candidates_per_generator,
+            seen_horizon=settings.seen_horizon,
+            render_budget=self.render_budget,
+            schedulers=self.schedulers,
+            backend=settings.compositing_backend,
+            storage_backend=self.storage_backend,
+            max_sessions=settings.max_sessions_per_generator,
         )
         return new_gen
 
+    def _storage_dir(self, kind, screen_w, screen_h):
+        parts = [self.storage_root, kind]
+        if not self.storage_backend.local:
+            parts.append(settings.storage_instance)
+        return os.path.join(*parts, f"{screen_w}x{screen_h}")
+
     async def _remove_generator(self, key):
         self.logger.debug(f"Removing generator [{key}]")
-        # TODO: check that task is cancelled
-        self.generators[key].stop()
+        await self.generators[key].stop()
+        # Also drops its download and render jobs still waiting for a worker
+        self.tasks[key].cancel()
         del self.generators[key]
         del self.tasks[key]
 
 
+def _create_storage_backend():
+    if settings.storage_backend == "local":
+        return LocalBackend()
+    if settings.storage_backend == "memory":
+        return MemoryBackend()
+    if settings.storage_backend == "s3":
+        return S3Backend(
+            settings.s3_endpoint_url,
+            settings.s3_bucket,
+            settings.s3_access_key,
+            settings.s3_secret_key,
+            region=settings.s3_region,
+            prefix=settings.s3_prefix,
+        )
+    raise ValueError(f"Unknown storage backend [{settings.storage_backend}]")
+
+
 def _sort_k_by_v(d: dict):
     """
     Return keys of the dict sorted by their values
     """
-    return sorted((k for k, v in d.items()), key=lambda kv: kv[1])
+    return sorted(d.keys(), key=lambda k: d[k])
 
 
 def _sort_k_by_v_join(left: dict, right: dict, default=0):
     """
     Return keys of left dict sorted by their values in right dict
     """
-    return sorted((k for k, v in left))
+    return sorted(left.keys(), key=lambda k: right.get(k, default))
@@ -1,11 +1,36 @@
-from PIL import Image
+from PIL import Image, ImageOps
 from typing import Tuple, List
 import io
+import numpy as np
+import struct
+import zlib
+
+BACKENDS = ("pil", "numpy")
+
+# Rows scaled, copied or encoded at once by the numpy backend
+_strip_height = 64
 
 
 class SubImage:
-    def __init__(self, filename: str, width: int, height: int):
+    __slots__ = (
+        "filename",
+        "opener",
+        "src_width",
+        "src_height",
+        "width",
+        "height",
+        "x",
+        "y",
+        "box_width",
+        "box_height",
+    )
+
+    def __init__(self, filename: str, width: int, height: int, opener=None):
         self.filename = filename
+        # Maps the filename to what PIL opens, e.g. Storage.get_source
+        self.opener = opener
+        self.src_width = width
+        self.src_height = height
         self.width = width
         self.height = height
         self.x = 0
@@ -20,12 +45,46 @@ class SubImage:
         self.x = box_x
         self.y = box_y
 
+    def open(self):
+        return Image.open(
+            self.opener(self.filename) if self.opener is not None else self.filename
+        )
+
     def get_image(self):
-        with Image.open(self.filename) as img:
+        with self.open() as img:
             img = self._scale(img)
             img = self._crop(img)
         return img
 
+    def iter_tile(self):
+        """
+        Yield the visible part of the image a strip of rows at a time with
+        the position of each strip, scaled straight from the source so no
+        scaled copy of the whole image is made
+        """
+        w = self.width
+        h = self.height
+        bw = self._attr("box_width", self.width)
+        bh = self._attr("box_height", self.height)
+        nw = min(w, bw)
+        nh = min(h, bh)
+        nx = (w - nw) // 2
+        ny = (h - nh) // 2
+        x = self.x + (bw - nw) // 2
+        y = self.y + (bh - nh) // 2
+        with self.open() as img:
+            # Let JPEG decode at a reduced scale when downscaling a lot
+            img.draft("RGB", (w, h))
+            sx = img.width / w
+            sy = img.height / h
+            for ty in range(0, nh, _strip_height):
+                th = min(_strip_height, nh - ty)
+                box = (nx * sx, (ny + ty) * sy, (nx + nw) * sx, (ny + ty + th) * sy)
+                strip = img.resize((nw, th), box=box)
+                if strip.mode != "RGB":
+                    strip = strip.convert("RGB")
+                yield strip, (x, y + ty)
+
     def get_pos(self):
         return self.x, self.y
 
@@ -58,32 +117,83 @@ class SubImage:
 
 
 class Wall:
-    def __init__(self, width, height):
+    """
+    Backends:
+    - pil: paste scaled and cropped copies of the images onto a canvas
+    - numpy: scale the visible part of each image straight into its slice
+      of a preallocated array
+    """
+
+    def __init__(self, width, height, backend="pil"):
+        assert backend in BACKENDS
         self.width = width
         self.height = height
+        self.backend = backend
         self.subs = []
 
     def add(self, subimage):
         self.subs.append(subimage)
 
+    def get_cost(self) -> int:
+        """
+        Estimate the peak number of pixels write_png holds in memory:
+        the canvas plus the largest tile being composited
+        """
+        if self.backend == "numpy":
+            # The source is scaled a strip at a time, and the canvas is
+            # encoded in place with a strip of rows in each of the filters
+            tile = max(
+                s.src_width * s.src_height + s.width * _strip_height for s in self.subs
+            )
+            return self.width * self.height + tile + 4 * self.width * _strip_height
+        tile = max(
+            s.src_width * s.src_height + 2 * s.width * s.height for s in self.subs
+        )
+        return self.width * self.height + tile
+
     def get_png(self, tracer) -> Tuple[List[str], bytes]:
-        with tracer.start_as_current_span("Image.new"):
-            wall = Image.new("RGB", (self.width, self.height))
+        buff = io.BytesIO()
+        used_keys = self.write_png(buff, tracer)
+        return used_keys, buff.getvalue()
+
+    def write_png(self, out, tracer) -> List[str]:
+        """
+        Encode the wall into a file-like object as the encoder goes
+        """
         with tracer.start_as_current_span("arrange_boxes"):
             arranged = self._arrange_used_boxes()
         assert arranged
 
-        used_keys = []
+        if self.backend == "numpy":
+            canvas = self._composite_numpy(arranged, tracer)
+            with tracer.start_as_current_span("write_png"):
+                write_png(canvas, out)
+        else:
+            wall = self._composite_pil(arranged, tracer)
+            with tracer.start_as_current_span("wall.save"):
+                wall.save(out, format="PNG")
+        return [sub.filename for sub in arranged]
+
+    def _composite_pil(self, arranged, tracer):
+        with tracer.start_as_current_span("Image.new"):
+            wall = Image.new("RGB", (self.width, self.height))
         for sub in arranged:
             with tracer.start_as_current_span("get_image"):
                 img = sub.get_image()
             with tracer.start_as_current_span("paste"):
                 wall.paste(img, sub.get_pos())
-            used_keys.append(sub.filename)
-        buff = io.BytesIO()
-        with tracer.start_as_current_span("wall.save"):
-            wall.save(buff, format="PNG")
-        return used_keys, buff.getvalue()
+        return wall
+
+    def _composite_numpy(self, arranged, tracer):
+        with tracer.start_as_current_span("np.zeros"):
+            canvas = np.zeros((self.height, self.width, 3), dtype=np.uint8)
+        for sub in arranged:
+            with tracer.start_as_current_span("copy_tile"):
+                for strip, (x, y) in sub.iter_tile():
+                    canvas[y : y + strip.height, x : x + strip.width] = np.asarray(
+                        strip
+                    )
+        return canvas
 
     def _arrange_used_boxes(self):
         assert self.subs
@@ -91,6 +201,62 @@ class Wall:
         return arranged
 
 
+def write_png(pixels, out, compress_level=6):
+    """
+    Encode an RGB array as PNG a strip of rows at a time, choosing the
+    None, Sub or Up filter per row, so no copy of the whole image is made
+    """
+    height, width, _ = pixels.shape
+    rows = pixels.reshape(height, width * 3)
+    out.write(b"\x89PNG\r\n\x1a\n")
+    _write_png_chunk(
+        out, b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    )
+    compressor = zlib.compressobj(compress_level)
+    prev = np.zeros((1, width * 3), dtype=np.uint8)
+    for y in range(0, height, _strip_height):
+        cur = rows[y : y + _strip_height]
+        n = len(cur)
+        filtered = np.empty((3, n, width * 3), dtype=np.uint8)
+        filtered[0] = cur
+        filtered[1, :, :3] = cur[:, :3]
+        np.subtract(cur[:, 3:], cur[:, :-3], out=filtered[1, :, 3:])
+        np.subtract(cur, np.vstack([prev, cur[:-1]]), out=filtered[2])
+        # Usual heuristic: smallest sum of residuals as signed bytes
+        # (widened first, as abs(int8(-128)) overflows back to -128)
+        cost = np.abs(filtered.view(np.int8).astype(np.int16)).sum(
+            axis=2, dtype=np.int64
+        )
+        choice = cost.argmin(axis=0)
+        data = np.empty((n, width * 3 + 1), dtype=np.uint8)
+        data[:, 0] = choice
+        data[:, 1:] = filtered[choice, np.arange(n)]
+        _write_png_chunk(out, b"IDAT", compressor.compress(data.tobytes()))
+        prev = cur[-1:]
+    _write_png_chunk(out, b"IDAT", compressor.flush())
+    _write_png_chunk(out, b"IEND", b"")
+
+
+def _write_png_chunk(out, kind, data):
+    if not data and kind == b"IDAT":
+        return
+    out.write(struct.pack(">I", len(data)))
+    out.write(kind)
+    out.write(data)
+    out.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(kind))))
+
+
+def rescale(source, width, height) -> bytes:
+    """
+    Scale an image to cover @width x @height, cropping the center
+    """
+    with Image.open(source) as img:
+        img = ImageOps.fit(img.convert("RGB"), (width, height))
+    buff = io.BytesIO()
+    img.save(buff, format="PNG")
+    return buff.getvalue()
+
+
 # r rows, c cols
 def layout_r_c(r, c, screen_w, screen_h, boxes):
     """
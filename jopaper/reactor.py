@@ -1,12 +1,22 @@
-from dataclasses import dataclass
-from typing import Callable, List
+from collections import deque
+from dataclasses import dataclass, field
+from typing import List
+import numpy as np
 import random
 import requests
+import threading
 import time
 import base64
+import os
 
+# Overridable to point at a stand-in upstream, e.g. for load tests
+api_url = os.environ.get("JOYREACTOR_API_URL", "https://api.joyreactor.cc/graphql")
+image_url = os.environ.get(
+    "JOYREACTOR_IMAGE_URL", "https://img10.joyreactor.cc/pics/post/full"
+)
 
-@dataclass
+
+@dataclass(slots=True)
 class Image:
     url: str
     file_type: str
@@ -15,52 +25,160 @@ class Image:
     height: int
 
 
-def filter_type(file_types):
-    return lambda image: image.file_type in ["png", "jpeg"]
+@dataclass
+class Constraints:
+    """Requirements an image has to meet to be used for one resolution"""
 
+    min_width: float
+    min_height: float
+    ratios: List[float]
+    ratio_error: float = 0.3
+    file_types: List[str] = field(default_factory=lambda: ["png", "jpeg"])
 
-def filter_size(width, height):
-    return lambda image: image.width >= width and image.height >= height
 
+def get_default_constraints(width, height):
+    return Constraints(
+        min_width=width / 4,
+        min_height=height / 2,
+        ratios=[width / height, width / 4 / height],
+    )
+
+
+def filter_type(file_types, constraints):
+    """
+    Return (images x constraints) mask of images with acceptable file types
+    """
+    return np.stack([np.isin(file_types, c.file_types) for c in constraints], axis=1)
 
-def filter_ratios(ratios, error=0.3):
-    ratios = [r for r in ratios]
 
-    def filter(image):
-        ratio = image.width / image.height
-        for r in ratios:
-            if abs(r - ratio) / r < error:
-                return True
-        return False
+def filter_size(widths, heights, constraints):
+    """
+    Return (images x constraints) mask of images big enough
+    """
+    min_w = np.array([c.min_width for c in constraints], dtype=float)
+    min_h = np.array([c.min_height for c in constraints], dtype=float)
+    return (widths[:, None] >= min_w[None, :]) & (heights[:, None] >= min_h[None, :])
 
-    return filter
 
+def filter_ratios(widths, heights, constraints):
+    """
+    Return (images x constraints) mask of images close enough to any of
+    the ratios of a constraint
+    """
+    n_ratios = max(len(c.ratios) for c in constraints)
+    # Constraints with fewer ratios are padded with nan which never matches
+    ratios = np.full((len(constraints), n_ratios), np.nan)
+    for i, c in enumerate(constraints):
+        ratios[i, : len(c.ratios)] = c.ratios
+    error = np.array([c.ratio_error for c in constraints], dtype=float)
 
-def get_default_filters(width, height):
-    return [
-        filter_type(["png", "jpeg"]),
-        filter_size(width / 4, height / 2),
-        filter_ratios([width / height, width / 4 / height]),
-    ]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        image_ratios = widths / heights
+        diff = np.abs(ratios[None, :, :] - image_ratios[:, None, None])
+        matched = diff / ratios[None, :, :] < error[None, :, None]
+    return matched.any(axis=2)
+
+
+def match_images(images: List[Image], constraints: List[Constraints]):
+    """
+    Evaluate every image against every constraint at once.
+    Return a boolean (images x constraints) matrix.
+    """
+    if not images or not constraints:
+        return np.zeros((len(images), len(constraints)), dtype=bool)
+    widths = np.array([i.width for i in images], dtype=float)
+    heights = np.array([i.height for i in images], dtype=float)
+    file_types = np.array([i.file_type for i in images])
+    return (
+        filter_type(file_types, constraints)
+        & filter_size(widths, heights, constraints)
+        & filter_ratios(widths, heights, constraints)
+    )
 
 
 class Source:
-    def __init__(self, logger, filters: List[Callable[[Image], bool]]):
+    """
+    Fetches random posts and routes their images to every subscribed
+    resolution they suit, so one upstream page feeds many generators.
+    Thread safe: get_image is called from executor threads.
+    """
+
+    def __init__(self, logger, max_cached: int = 100, demand_fetches: int = 1):
         self.logger = logger
-        self.filters = filters
-        self.cache = []
-
-    def get_image(self):
-        while not self.cache:
-            self.logger.debug("Requesting random posts")
-            posts = self._get_more_posts()
-            self.logger.debug(f"Got {len(posts)} posts")
-            images = _extract_images(posts, self.logger)
-            self.logger.debug(f"Got {len(images)} images")
-            images = _filter_images(images, self.filters)
-            self.logger.debug(f"Got {len(images)} suitable images")
-            self.cache = images
-        return self.cache.pop()
+        self.max_cached = max_cached
+        # Pages to fetch looking for a demanded image before taking any
+        self.demand_fetches = demand_fetches
+        self.lock = threading.Lock()
+        self.fetch_lock = threading.Lock()
+        self.constraints = {}
+        self.caches = {}
+
+    def subscribe(self, key, constraints: Constraints):
+        with self.lock:
+            self.constraints[key] = constraints
+            self.caches.setdefault(key, deque(maxlen=self.max_cached))
+
+    def unsubscribe(self, key):
+        with self.lock:
+            self.constraints.pop(key, None)
+            self.caches.pop(key, None)
+
+    def get_image(self, key, demand: List[Constraints] = None):
+        """
+        Return the next image for the resolution. With @demand, prefer an
+        image meeting the earliest constraints possible and fetch up to
+        demand_fetches more pages for one before settling for any image
+        """
+        tries = self.demand_fetches if demand else 0
+        while True:
+            image = self._pop_cached(key, demand, strict=tries > 0)
+            if image is not None:
+                return image
+            with self.fetch_lock:
+                # Another thread could have fetched a page while we waited
+                image = self._pop_cached(key, demand, strict=tries > 0)
+                if image is not None:
+                    return image
+                self._fetch()
+            tries = max(tries - 1, 0)
+
+    def get_cached_count(self, key):
+        with self.lock:
+            cache = self.caches.get(key)
+            return len(cache) if cache is not None else 0
+
+    def _pop_cached(self, key, demand=None, strict=False):
+        """
+        Pop the newest cached image meeting the earliest @demand constraints
+        it can, or just the newest one unless @strict
+        """
+        with self.lock:
+            cache = self.caches[key]
+            if demand and cache:
+                matched = match_images(cache, demand)
+                for col in range(len(demand)):
+                    hits = np.flatnonzero(matched[:, col])
+                    if hits.size:
+                        image = cache[hits[-1]]
+                        del cache[hits[-1]]
+                        return image
+                if strict:
+                    return None
+            return cache.pop() if cache else None
+
+    def _fetch(self):
+        self.logger.debug("Requesting random posts")
+        posts = self._get_more_posts()
+        self.logger.debug(f"Got {len(posts)} posts")
+        images = _extract_images(posts, self.logger)
+        self.logger.debug(f"Got {len(images)} images")
+        with self.lock:
+            keys = list(self.constraints.keys())
+            matched = match_images(images, [self.constraints[k] for k in keys])
+            for col, key in enumerate(keys):
+                suitable = [images[i] for i in np.flatnonzero(matched[:, col])]
+                self.caches[key].extend(suitable)
+                self.logger.debug(f"Got {len(suitable)} suitable images for {key}")
 
     def _get_more_posts(self):
         try:
@@ -77,7 +195,7 @@ def _request_random_posts():
     # 1000 seems to be the limit
     page = random.randint(0, 1000)
 
-    url = "https://api.joyreactor.cc/graphql"
+    url = api_url
     query = (
         """
       query MyQuery {
@@ -126,9 +244,7 @@ def _get_url(image_id, tags, ftype):
     image_id = image_id.split(":")[1]
     tags = "-".join(tags[:3])
 
-    return ("https://img10.joyreactor.cc/pics/post/full/" "{}-{}.{}").format(
-        tags, image_id, ftype
-    )
+    return "{}/{}-{}.{}".format(image_url, tags, image_id, ftype)
 
 
 def _extract_images(posts, logger):
@@ -154,11 +270,4 @@ def _extract_images(posts, logger):
     return images
 
 
-def _filter_images(images, filters):
-    ret = images
-    for f in filters:
-        ret = filter(f, ret)
-    return list(ret)
-
-
 random.seed()
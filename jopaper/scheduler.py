@@ -0,0 +1,163 @@
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import itertools
+import threading
+from typing import Callable
+
+# Work priorities, most urgent first
+PRIORITY_INTERACTIVE = 0  # a request is waiting for the result
+PRIORITY_EMPTY = 1  # the queue of ready wallpapers is empty
+PRIORITY_REFILL = 2  # topping up the queue
+
+
+class RenderBudget:
+    """
+    Admits renders against a global budget of pixels held in memory at
+    once. Renders that don't fit wait, the most urgent first and then in
+    arrival order; a render bigger than the whole budget runs alone.
+    Thread safe: renders run in executor threads.
+    """
+
+    def __init__(self, max_pixels: int = None):
+        self.max_pixels = max_pixels
+        self.condition = threading.Condition()
+        self.used_pixels = 0
+        self.running = 0
+        self.tickets = itertools.count()
+        self.waiting = []
+
+    @contextlib.contextmanager
+    def reserve(self, pixels: int, priority: Callable[[], int] = None):
+        """
+        Hold @pixels of the budget for the block. @priority is evaluated
+        whenever waiting renders are admitted, like WorkScheduler's.
+        """
+        with self.condition:
+            waiter = (next(self.tickets), priority)
+            self.waiting.append(waiter)
+            try:
+                self.condition.wait_for(lambda: self._admissible(waiter, pixels))
+            finally:
+                self.waiting.remove(waiter)
+                self.condition.notify_all()
+            self.used_pixels += pixels
+            self.running += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.used_pixels -= pixels
+                self.running -= 1
+                self.condition.notify_all()
+
+    def get_state(self):
+        with self.condition:
+            return {
+                "max_pixels": self.max_pixels,
+                "used_pixels": self.used_pixels,
+                "running": self.running,
+                "waiting": len(self.waiting),
+            }
+
+    def _admissible(self, waiter, pixels):
+        if min(self.waiting, key=_waiter_order) is not waiter:
+            return False
+        if self.max_pixels is None or self.running == 0:
+            return True
+        return self.used_pixels + pixels <= self.max_pixels
+
+
+def _waiter_order(waiter):
+    ticket, priority = waiter
+    try:
+        return priority() if priority is not None else PRIORITY_REFILL, ticket
+    except Exception:
+        return PRIORITY_REFILL, ticket
+
+
+class _Job:
+    __slots__ = ("seq", "f", "priority", "future")
+
+    def __init__(self, seq, f, priority):
+        self.seq = seq
+        self.f = f
+        self.priority = priority
+        self.future = concurrent.futures.Future()
+
+
+class WorkScheduler:
+    """
+    Runs blocking work on a pool of threads, most urgent job first.
+    Priorities are callables evaluated when a worker picks the next job,
+    so a job's urgency follows demand while it waits.
+    """
+
+    def __init__(self, name: str, max_workers: int, logger):
+        self.name = name
+        self.logger = logger
+        self.condition = threading.Condition()
+        self.pending = []
+        self.seq = itertools.count()
+        self.running = 0
+        self.stopped = False
+        self.workers = [
+            threading.Thread(target=self._work, name=f"{name}_{n}", daemon=True)
+            for n in range(max_workers)
+        ]
+        for worker in self.workers:
+            worker.start()
+
+    async def run(self, f, priority: Callable[[], int]):
+        job = _Job(next(self.seq), f, priority)
+        with self.condition:
+            if self.stopped:
+                raise RuntimeError(f"Scheduler {self.name} is stopped")
+            self.pending.append(job)
+            self.condition.notify()
+        return await asyncio.wrap_future(job.future)
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            for job in self.pending:
+                job.future.cancel()
+            self.pending.clear()
+            self.condition.notify_all()
+
+    def get_state(self):
+        with self.condition:
+            pending = collections.Counter(self._priority(j) for j in self.pending)
+            return {
+                "workers": len(self.workers),
+                "running": self.running,
+                "pending": dict(sorted(pending.items())),
+            }
+
+    def _work(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.pending or self.stopped)
+                if self.stopped:
+                    return
+                job = min(self.pending, key=lambda j: (self._priority(j), j.seq))
+                self.pending.remove(job)
+                self.running += 1
+            try:
+                # Skip jobs whose caller is gone
+                if job.future.set_running_or_notify_cancel():
+                    try:
+                        job.future.set_result(job.f())
+                    except Exception as e:
+                        job.future.set_exception(e)
+            finally:
+                with self.condition:
+                    self.running -= 1
+
+    def _priority(self, job):
+        try:
+            return job.priority()
+        except Exception:
+            self.logger.error("Error evaluating job priority", exc_info=True)
+            return PRIORITY_REFILL
@@ -1,34 +1,108 @@
 import os
 import requests
 from typing import List
-import shutil
+import contextlib
 import datetime
-from pydantic_settings import BaseSettings
-from pathlib import Path
+import hashlib
+import threading
+from array import array
+from jopaper.storage_backends import LocalBackend, StorageBackend
 
-
-class Settings(BaseSettings):
-    max_used_cnt: int = 20
-    max_wallpaper_cnt: int = 20
+_request_timeout = 1.0
 
 
-settings = Settings()
-
-_request_timeout = 1.0
+class SeenIndex:
+    """
+    Persistent set of the last @horizon downloaded urls.
+    Urls are kept as 64-bit hashes in an append-only file which is
+    compacted once it holds twice the horizon. Without a @path the set
+    only lives in memory.
+    """
+
+    def __init__(self, path: str, horizon: int):
+        self.path = path
+        self.horizon = horizon
+        self.hashes = array("Q")
+        if horizon > 0 and path is not None and os.path.isfile(path):
+            with open(path, "rb") as f:
+                data = f.read()
+            # Drop a torn trailing record, if any
+            self.hashes.frombytes(data[: len(data) // 8 * 8])
+            self.hashes = self.hashes[-horizon:]
+        self.lookup = set(self.hashes)
+
+    def __contains__(self, url: str) -> bool:
+        return _url_hash(url) in self.lookup
+
+    def __len__(self):
+        return len(self.lookup)
+
+    def add(self, url: str):
+        if self.horizon <= 0:
+            return
+        h = _url_hash(url)
+        if h in self.lookup:
+            return
+        self.hashes.append(h)
+        self.lookup.add(h)
+        if len(self.hashes) > self.horizon:
+            self.lookup.discard(self.hashes[-self.horizon - 1])
+        if len(self.hashes) > 2 * self.horizon:
+            self._compact()
+        elif self.path is not None:
+            with open(self.path, "ab") as f:
+                f.write(h.to_bytes(8, "little"))
+
+    def _compact(self):
+        self.hashes = self.hashes[-self.horizon :]
+        if self.path is None:
+            return
+        tmp = self.path + ".tmp"
+        with open(tmp, "wb") as f:
+            self.hashes.tofile(f)
+        os.replace(tmp, self.path)
 
 
 class Storage:
-    def __init__(self, download_dir: str, used_dir: str, wallpaper_dir: str, logger):
+    """
+    Downloaded, used and wallpaper files of one resolution. Files are
+    spread over hash-prefixed subdirectories of each directory and kept
+    in a StorageBackend, the local filesystem by default; with other
+    backends the directories are key prefixes.
+    """
+
+    def __init__(
+        self,
+        download_dir: str,
+        used_dir: str,
+        wallpaper_dir: str,
+        logger,
+        max_used_cnt: int = 20,
+        max_wallpaper_cnt: int = 20,
+        seen_horizon: int = 10000,
+        backend: StorageBackend = None,
+    ):
         self.logger = logger
+        self.backend = backend if backend is not None else LocalBackend()
         self.download_dir = download_dir
         self.used_dir = used_dir
         self.wallpaper_dir = wallpaper_dir
-
-        os.makedirs(download_dir, exist_ok=True)
-        os.makedirs(used_dir, exist_ok=True)
-        os.makedirs(wallpaper_dir, exist_ok=True)
-
-        self.downloads = set(_read_directory(self.download_dir, "img"))
+        self.max_used_cnt = max_used_cnt
+        self.max_wallpaper_cnt = max_wallpaper_cnt
+
+        seen_path = None
+        if self.backend.local:
+            os.makedirs(download_dir, exist_ok=True)
+            os.makedirs(used_dir, exist_ok=True)
+            os.makedirs(wallpaper_dir, exist_ok=True)
+            seen_path = os.path.join(download_dir, "seen.bin")
+
+        self.downloads = set(self._list(self.download_dir, "img"))
+        # Complete wallpapers, so cleaning up doesn't list the backend;
+        # added to by renders in worker threads
+        self.wallpapers = set(self._list(self.wallpaper_dir, "wallpaper"))
+        self.wallpapers_lock = threading.Lock()
+        self.seen = SeenIndex(seen_path, seen_horizon)
 
         self.counter = 0
 
@@ -37,42 +111,79 @@ class Storage:
         response = requests.get(url, timeout=_request_timeout)
         if response.status_code not in [200, 302]:
             raise RuntimeError("Unexpected response {}".format(response.status_code))
-        with open(path, "wb") as f:
-            f.write(response.content)
+        self.backend.put(path, response.content)
 
         self.downloads.add(path)
+        self.seen.add(url)
         return path
 
+    def is_seen(self, url: str) -> bool:
+        return url in self.seen
+
     def get_downloads(self) -> List[str]:
         return list(self.downloads)
 
+    def get_source(self, filename):
+        """
+        Return what PIL can open the file from: its path if the backend
+        keeps local files, otherwise a file object with its contents
+        """
+        return filename if self.backend.local else self.backend.open(filename)
+
     def mark_used(self, src) -> str:
         self.downloads.remove(src)
         ftype = src.split(".")[-1]
         dest = _get_path(self.used_dir, "img", self._count(), ftype)
-        shutil.move(src, dest)
+        self.backend.move(src, dest)
 
-        old_files = _clean_directory(self.used_dir, "img", settings.max_used_cnt)
+        old_files = self._get_old(self.used_dir, "img", self.max_used_cnt)
+        self._rm_files(old_files)
         if old_files:
             self.logger.debug(
                 f"Used images clean up: removed {len(old_files)} old files"
             )
         return dest
 
+    def rm_download(self, src):
+        self.downloads.discard(src)
+        self._rm_files([src])
+
     def save_wallpaper(self, image: bytes, rm_callback=None) -> str:
-        ftype = "png"
-        fname = _get_path(self.wallpaper_dir, "wallpaper", self._count(), ftype)
-        with open(fname, "wb") as f:
+        with self.wallpaper_writer() as (fname, f):
             f.write(image)
         return fname
 
-    def get_old_wallpapers(self):
-        return _clean_directory(
-            self.wallpaper_dir, "wallpaper", settings.max_wallpaper_cnt, dry_run=True
-        )
-        pass
+    @contextlib.contextmanager
+    def wallpaper_writer(self):
+        """
+        Yield a filename and a file to write a wallpaper into. The file
+        only appears under that name once it is complete.
+        """
+        ftype = "png"
+        fname = _get_path(self.wallpaper_dir, "wallpaper", self._count(), ftype)
+        with self.backend.writer(fname) as f:
+            yield fname, f
+        with self.wallpapers_lock:
+            self.wallpapers.add(fname)
+
+    def pop_old_wallpapers(self, exclude=()):
+        """
+        Forget and return the wallpapers beyond the newest
+        max_wallpaper_cnt, not counting the @exclude ones which are never
+        old. Doesn't touch the backend; remove them with rm_wallpapers.
+        """
+        with self.wallpapers_lock:
+            # Names start with the creation time
+            files = sorted(
+                (f for f in self.wallpapers if f not in exclude),
+                key=os.path.basename,
+            )
+            old_files = files[: -self.max_wallpaper_cnt]
+            self.wallpapers.difference_update(old_files)
+        return old_files
 
     def rm_wallpapers(self, old_files):
+        self._rm_files(old_files)
         if old_files:
             self.logger.debug(
                 f"Wallpapers clean up: removed {len(old_files)} old files"
@@ -82,31 +193,36 @@ class Storage:
         self.counter += 1
         return self.counter
 
+    def _list(self, dirname, prefix):
+        return [
+            key
+            for key in self.backend.list(dirname)
+            if os.path.basename(key).startswith(prefix)
+        ]
 
-def _read_directory(dirname, prefix):
-    for fname in os.listdir(dirname):
-        fullname = os.path.join(dirname, fname)
-        if not os.path.isfile(fullname):
-            continue
-        if not fname.startswith(prefix):
-            continue
-        yield fullname
+    def _get_old(self, dirname, prefix, to_keep):
+        # Names start with the creation time, whatever subdirectory they're in
+        files = sorted(self._list(dirname, prefix), key=os.path.basename)
+        return files[:-to_keep]
 
+    def _rm_files(self, files):
+        for file in files:
+            self.backend.delete(file)
 
-def _get_path(dirname, prefix, count, ftype):
-    now = datetime.datetime.now().isoformat("_", "milliseconds")
-    return os.path.join(dirname, f"{prefix}-{now}-{count}.{ftype}")
+
+def _url_hash(url):
+    digest = hashlib.blake2b(url.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
 
 
-def _clean_directory(dirname, prefix, to_keep, dry_run=False):
-    files = _read_directory(dirname, prefix)
-    files = sorted(files)
-    files = files[:-to_keep]
-    if not dry_run:
-        _rm_files(files)
-    return files
+def _get_path(dirname, prefix, count, ftype):
+    now = datetime.datetime.now().isoformat("_", "milliseconds")
+    fname = f"{prefix}-{now}-{count}.{ftype}"
+    return os.path.join(dirname, _shard(fname), fname)
 
 
-def _rm_files(files):
-    for file in files:
-        Path.unlink(file, missing_ok=True)
+def _shard(fname):
+    """
+    One of 256 subdirectories, so no directory grows too big to list
+    """
+    return hashlib.blake2b(fname.encode("utf-8"), digest_size=1).hexdigest()
@@ -0,0 +1,339 @@
+import contextlib
+import datetime
+import hashlib
+import hmac
+import io
+import os
+import tempfile
+import threading
+import xml.etree.ElementTree as ET
+from pathlib import Path
+from typing import BinaryIO, List
+from urllib.parse import quote, urlsplit
+
+import requests
+
+_request_timeout = 10.0
+
+# Upload bodies bigger than this are spooled to disk before sending
+_spool_size = 16 * 1024 * 1024
+
+_empty_sha256 = hashlib.sha256(b"").hexdigest()
+
+_s3_ns = {"s3": "http://s3.amazonaws.com/doc/2006-03-01/"}
+
+
+class StorageBackend:
+    """
+    Key -> bytes store behind Storage. Keys are "/"-separated paths.
+    Thread safe.
+    """
+
+    # Whether keys are paths of local files which can be opened directly
+    local = False
+
+    @contextlib.contextmanager
+    def writer(self, key: str):
+        """
+        Yield a binary file to write the object into. It only appears under
+        @key once the block exits without an error.
+        """
+        raise NotImplementedError
+
+    def read(self, key: str) -> bytes:
+        """
+        Return the object, raise FileNotFoundError if there is none
+        """
+        raise NotImplementedError
+
+    def list(self, prefix: str) -> List[str]:
+        """
+        Return the keys of all objects under the @prefix directory
+        """
+        raise NotImplementedError
+
+    def delete(self, key: str):
+        """
+        Remove the object if it exists
+        """
+        raise NotImplementedError
+
+    def open(self, key: str) -> BinaryIO:
+        return io.BytesIO(self.read(key))
+
+    def put(self, key: str, data: bytes):
+        with self.writer(key) as f:
+            f.write(data)
+
+    def move(self, src: str, dst: str):
+        self.put(dst, self.read(src))
+        self.delete(src)
+
+
+class LocalBackend(StorageBackend):
+    """
+    Local filesystem, keys are file paths. Objects are written next to
+    their final name and renamed into place once complete.
+    """
+
+    local = True
+
+    @contextlib.contextmanager
+    def writer(self, key: str):
+        os.makedirs(os.path.dirname(key) or ".", exist_ok=True)
+        part = key + ".part"
+        try:
+            with open(part, "wb") as f:
+                yield f
+            os.replace(part, key)
+        except BaseException:
+            Path.unlink(part, missing_ok=True)
+            raise
+
+    def read(self, key: str) -> bytes:
+        with open(key, "rb") as f:
+            return f.read()
+
+    def open(self, key: str) -> BinaryIO:
+        return open(key, "rb")
+
+    def list(self, prefix: str) -> List[str]:
+        keys = []
+        for dirpath, _, fnames in os.walk(prefix):
+            keys.extend(
+                os.path.join(dirpath, fname)
+                for fname in fnames
+                if not fname.endswith(".part")
+            )
+        return keys
+
+    def delete(self, key: str):
+        Path.unlink(key, missing_ok=True)
+
+    def move(self, src: str, dst: str):
+        os.makedirs(os.path.dirname(dst) or ".", exist_ok=True)
+        os.replace(src, dst)
+
+
+class MemoryBackend(StorageBackend):
+    """
+    Objects kept in process memory, for ephemeral runs and tests
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.objects = {}
+
+    @contextlib.contextmanager
+    def writer(self, key: str):
+        buff = io.BytesIO()
+        yield buff
+        with self.lock:
+            self.objects[key] = buff.getvalue()
+
+    def read(self, key: str) -> bytes:
+        with self.lock:
+            try:
+                return self.objects[key]
+            except KeyError:
+                raise FileNotFoundError(key) from None
+
+    def list(self, prefix: str) -> List[str]:
+        prefix = prefix.rstrip("/") + "/"
+        with self.lock:
+            return [key for key in self.objects if key.startswith(prefix)]
+
+    def delete(self, key: str):
+        with self.lock:
+            self.objects.pop(key, None)
+
+    def move(self, src: str, dst: str):
+        with self.lock:
+            try:
+                self.objects[dst] = self.objects.pop(src)
+            except KeyError:
+                raise FileNotFoundError(src) from None
+
+
+class S3Backend(StorageBackend):
+    """
+    Bucket of an S3-compatible object store, addressed path-style
+    (endpoint/bucket/key) and signed with AWS signature version 4.
+    Uploads become visible atomically when complete.
+    """
+
+    def __init__(
+        self,
+        endpoint_url: str,
+        bucket: str,
+        access_key: str,
+        secret_key: str,
+        region: str = "us-east-1",
+        prefix: str = "",
+    ):
+        self.endpoint_url = endpoint_url.rstrip("/")
+        self.host = urlsplit(self.endpoint_url).netloc
+        self.bucket = bucket
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.prefix = prefix.strip("/")
+        # requests.Session isn't documented as thread safe
+        self.local_sessions = threading.local()
+
+    @contextlib.contextmanager
+    def writer(self, key: str):
+        with tempfile.SpooledTemporaryFile(max_size=_spool_size) as f:
+            yield f
+            # S3 needs the length up front, requests would send an empty
+            # file chunked
+            size = f.tell()
+            f.seek(0)
+            self._request(
+                "PUT",
+                key,
+                headers={"Content-Length": str(size)},
+                data=f,
+                payload_hash="UNSIGNED-PAYLOAD",
+            )
+
+    def read(self, key: str) -> bytes:
+        return self._request("GET", key).content
+
+    def list(self, prefix: str) -> List[str]:
+        keys = []
+        query = {"list-type": "2", "prefix": self._key(prefix.rstrip("/") + "/")}
+        while True:
+            response = self._request("GET", None, query=query)
+            root = ET.fromstring(response.content)
+            for item in root.iterfind("s3:Contents/s3:Key", _s3_ns):
+                keys.append(
+                    item.text[len(self.prefix) + 1 :] if self.prefix else item.text
+                )
+            token = root.findtext("s3:NextContinuationToken", None, _s3_ns)
+            if root.findtext("s3:IsTruncated", "false", _s3_ns) != "true" or not token:
+                return keys
+            query = {**query, "continuation-token": token}
+
+    def delete(self, key: str):
+        with contextlib.suppress(FileNotFoundError):
+            self._request("DELETE", key)
+
+    def move(self, src: str, dst: str):
+        # There is no rename, copy server-side instead
+        source = quote(f"/{self.bucket}/{self._key(src)}", safe="/-_.~")
+        self._request("PUT", dst, headers={"x-amz-copy-source": source})
+        self.delete(src)
+
+    def _key(self, key):
+        return f"{self.prefix}/{key}" if self.prefix else key
+
+    def _request(
+        self,
+        method,
+        key,
+        query=None,
+        headers=None,
+        data=None,
+        payload_hash=_empty_sha256,
+    ):
+        path = f"/{self.bucket}" if key is None else f"/{self.bucket}/{self._key(key)}"
+        path = quote(path, safe="/-_.~")
+        query = _canonical_query(query or {})
+        headers = sign_v4(
+            method,
+            self.host,
+            path,
+            query,
+            headers or {},
+            payload_hash,
+            self.access_key,
+            self.secret_key,
+            self.region,
+            datetime.datetime.now(datetime.UTC).strftime("%Y%m%dT%H%M%SZ"),
+        )
+        url = self.endpoint_url + path + (f"?{query}" if query else "")
+        response = self._session().request(
+            method,
+            url,
+            headers=headers,
+            data=data,
+            timeout=_request_timeout,
+        )
+        if response.status_code == 404 and key is not None:
+            raise FileNotFoundError(key)
+        if response.status_code >= 300:
+            raise RuntimeError(
+                "Unexpected response {} to {} {}".format(
+                    response.status_code, method, path
+                )
+            )
+        return response
+
+    def _session(self):
+        session = getattr(self.local_sessions, "session", None)
+        if session is None:
+            session = self.local_sessions.session = requests.Session()
+        return session
+
+
+def sign_v4(
+    method,
+    host,
+    path,
+    query,
+    headers,
+    payload_hash,
+    access_key,
+    secret_key,
+    region,
+    amz_date,
+    service="s3",
+):
+    """
+    Return @headers with the ones AWS signature version 4 adds, including
+    Authorization. @path and @query must already be URI-encoded.
+    """
+    headers = {
+        **{k.lower(): str(v).strip() for k, v in headers.items()},
+        "host": host,
+        "x-amz-date": amz_date,
+        "x-amz-content-sha256": payload_hash,
+    }
+    signed_headers = ";".join(sorted(headers))
+    canonical_request = "\n".join(
+        [
+            method,
+            path,
+            query,
+            "".join(f"{k}:{headers[k]}\n" for k in sorted(headers)),
+            signed_headers,
+            payload_hash,
+        ]
+    )
+    date = amz_date[:8]
+    scope = f"{date}/{region}/{service}/aws4_request"
+    string_to_sign = "\n".join(
+        [
+            "AWS4-HMAC-SHA256",
+            amz_date,
+            scope,
+            hashlib.sha256(canonical_request.encode()).hexdigest(),
+        ]
+    )
+    key = ("AWS4" + secret_key).encode()
+    for part in (date, region, service, "aws4_request"):
+        key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+    signature = hmac.new(key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+    headers["authorization"] = (
+        f"AWS4-HMAC-SHA256 Credential={access_key}/{scope}, "
+        f"SignedHeaders={signed_headers}, Signature={signature}"
+    )
+    return headers
+
+
+def _canonical_query(query):
+    return "&".join(
+        f"{quote(k, safe='-_.~')}={quote(v, safe='-_.~')}"
+        for k, v in sorted(query.items())
+    )
@@ -0,0 +1,98 @@
+from fastapi.testclient import TestClient
+from jopaper import generator_service
+from PIL import Image
+import asyncio
+import importlib
+import io
+import os
+import pytest
+import sys
+import time
+
+SCREEN = {"screen_w": 320, "screen_h": 180}
+
+
+@pytest.fixture
+def api(monkeypatch):
+    """
+    The app with its files in memory and images rendered from generated
+    pictures instead of downloaded ones
+    """
+    monkeypatch.setattr(generator_service.settings, "storage_backend", "memory")
+    # The module reads its settings and builds its generators on import
+    monkeypatch.delitem(sys.modules, "jopaper.api", raising=False)
+    api = importlib.import_module("jopaper.api")
+    monkeypatch.setattr(api.settings, "wallpaper_deadline", 0)
+    new_generator = api.generators._new_generator
+
+    async def _new_generator(screen_w, screen_h):
+        generator = await new_generator(screen_w, screen_h)
+        generator._download_random_image = lambda: _download(
+            generator, api.settings.stream_wallpapers
+        )
+        return generator
+
+    monkeypatch.setattr(api.generators, "_new_generator", _new_generator)
+    return api
+
+
+async def _download(generator, wait_for_stream):
+    if wait_for_stream:
+        # Hold renders back until a client waits for a stream
+        while not generator.stream_requests:
+            await asyncio.sleep(0.01)
+    storage = generator.storage
+    image = io.BytesIO()
+    Image.new("RGB", (generator.screen_w, generator.screen_h), "red").save(image, "PNG")
+    filename = os.path.join(storage.download_dir, f"img-{storage._count()}.png")
+    storage.backend.put(filename, image.getvalue())
+    storage.downloads.add(filename)
+    return filename
+
+
+def _is_png(content):
+    with Image.open(io.BytesIO(content)) as img:
+        return img.format == "PNG" and img.size == (320, 180)
+
+
+def test_wallpapers_urls_serve_pngs(api):
+    with TestClient(api.app) as client:
+        response = client.get("/wallpapers", params={"session_id": "s", **SCREEN})
+        assert response.status_code == 200
+        urls = response.json()["urls"]
+        assert urls
+        for url in urls:
+            assert url.startswith("/static/wallpaper/")
+            assert "/320x180/" in url
+            image = client.get(url)
+            assert image.status_code == 200
+            assert image.headers["content-type"] == "image/png"
+            assert _is_png(image.content)
+
+
+def test_streamed_wallpaper_is_stored(api, monkeypatch):
+    monkeypatch.setattr(api.settings, "stream_wallpapers", True)
+    with TestClient(api.app) as client:
+        response = client.get("/wallpaper", params={"session_id": "s", **SCREEN})
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "image/png"
+        # Sent as it was encoded, before its size was known
+        assert "content-length" not in response.headers
+        assert _is_png(response.content)
+
+        generator = api.generators.generators[(320, 180)]
+        # Cached once the stream is done
+        deadline = time.monotonic() + 5
+        while not generator.cache.items and time.monotonic() < deadline:
+            time.sleep(0.01)
+        (wallpaper,) = generator.cache.items
+        assert api.generators.storage_backend.read(wallpaper) == response.content
+
+
+def test_status(api):
+    with TestClient(api.app) as client:
+        client.get("/wallpapers", params={"session_id": "s", **SCREEN})
+        status = client.get("/status").json()
+    assert status["render_budget"]["max_pixels"] == 200_000_000
+    assert status["render_budget"]["running"] >= 0
+    assert set(status["schedulers"]) == {"download", "render"}
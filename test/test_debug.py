@@ -0,0 +1,37 @@
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from jopaper import debug
+import threading
+
+
+def _busy(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+def test_sample_profile_sees_other_threads():
+    stop = threading.Event()
+    thread = threading.Thread(target=_busy, args=(stop,), name="busy")
+    thread.start()
+    try:
+        profile = debug.sample_profile(0.2, interval=0.001)
+    finally:
+        stop.set()
+        thread.join()
+    assert profile["samples"] > 0
+    assert profile["threads"]["busy"] > 0
+    assert any(f["function"].endswith("(_busy)") for f in profile["top"])
+
+
+def test_debug_endpoints_setting(monkeypatch):
+    monkeypatch.setenv("DEBUG_ENDPOINTS", "yes")
+    monkeypatch.setattr(debug, "settings", debug.Settings())
+    app = FastAPI()
+    debug.setup_debug(app, generators=None)
+    response = TestClient(app).get("/debug/memory", params={"stop": True})
+    assert response.json() == {"tracing": False}
+
+    monkeypatch.setattr(debug, "settings", debug.Settings(debug_endpoints=False))
+    app = FastAPI()
+    debug.setup_debug(app, generators=None)
+    assert TestClient(app).get("/debug/memory").status_code == 404
@@ -0,0 +1,283 @@
+from jopaper.generator import Cache, CandidatePool, Generator, WallpaperStream
+from jopaper.layout import SubImage
+from jopaper.storage_backends import MemoryBackend
+from PIL import Image
+import asyncio
+import io
+import logging
+import pytest
+
+
+def _sub(n, width=100, height=100):
+    return SubImage(f"img-{n}.png", width, height)
+
+
+def test_candidate_pool_take():
+    pool = CandidatePool(max_size=10)
+    for n in range(3):
+        assert pool.add(4, _sub(n)) == []
+    assert pool.take(4, 4) is None
+    assert pool.take(1, 1) is None
+
+    pool.add(4, _sub(3))
+    taken = pool.take(4, 4)
+    assert sorted(s.filename for s in taken) == [f"img-{n}.png" for n in range(4)]
+    assert len(pool) == 0
+
+
+def test_candidate_pool_evicts_oldest_of_largest_bucket():
+    pool = CandidatePool(max_size=3)
+    pool.add(1, _sub(0))
+    pool.add(4, _sub(1))
+    pool.add(4, _sub(2))
+    evicted = pool.add(4, _sub(3))
+    assert [s.filename for s in evicted] == ["img-1.png"]
+    assert len(pool) == 3
+    assert [s.filename for s in pool.take(1, 1)] == ["img-0.png"]
+
+
+def test_cache_get_many():
+    async def run():
+        cache = Cache(logging.getLogger(__name__))
+        for n in range(5):
+            await cache.add(f"wall-{n}", "producer")
+        assert await cache.get_many("session", 3) == ["wall-0", "wall-1", "wall-2"]
+        assert await cache.get_many("session", 3) == ["wall-3", "wall-4"]
+        assert await cache.get_many("session", 3) == []
+        assert await cache.get("producer") is None
+
+        await cache.add("wall-5", "producer")
+        assert await cache.get("session") == "wall-5"
+
+    asyncio.run(run())
+
+
+def test_cache_session_churn():
+    async def run():
+        cache = Cache(logging.getLogger(__name__), max_session_number=10)
+        await cache.add("wall-0", "producer")
+        for n in range(cache.max_session_number * 2):
+            assert await cache.get(f"session-{n}") == "wall-0"
+        assert len(cache.session_last_items) <= cache.max_session_number
+        # The most recent sessions survive
+        assert await cache.get(f"session-{n}") is None
+
+    asyncio.run(run())
+
+
+def test_wallpaper_stream():
+    async def run():
+        stream = WallpaperStream("session", asyncio.get_running_loop())
+        out = io.BytesIO()
+
+        def render():
+            assert stream.claim()
+            writer = stream.writer(out)
+            writer.write(b"abc")
+            writer.write(b"def")
+            stream.close()
+
+        await asyncio.to_thread(render)
+        await stream.started.wait()
+        assert not stream.cancel()
+        assert [c async for c in stream.iter_chunks()] == [b"abc", b"def"]
+        assert out.getvalue() == b"abcdef"
+
+    asyncio.run(run())
+
+
+def test_wallpaper_stream_backpressure():
+    async def run():
+        stream = WallpaperStream("session", asyncio.get_running_loop())
+        out = io.BytesIO()
+        chunks = [bytes([n]) for n in range(3 * stream.max_chunks)]
+
+        def render():
+            assert stream.claim()
+            writer = stream.writer(out)
+            for chunk in chunks:
+                writer.write(chunk)
+                assert stream.chunks.qsize() <= stream.max_chunks
+            stream.close()
+
+        rendering = asyncio.create_task(asyncio.to_thread(render))
+        received = []
+        async for chunk in stream.iter_chunks():
+            received.append(chunk)
+            await asyncio.sleep(0.001)
+        await rendering
+        assert received == chunks
+
+    asyncio.run(run())
+
+
+def test_wallpaper_stream_abandoned():
+    async def run():
+        stream = WallpaperStream("session", asyncio.get_running_loop())
+        out = io.BytesIO()
+        chunks = [bytes([n]) for n in range(3 * stream.max_chunks)]
+
+        def render():
+            assert stream.claim()
+            writer = stream.writer(out)
+            for chunk in chunks:
+                writer.write(chunk)
+            stream.close()
+
+        rendering = asyncio.create_task(asyncio.to_thread(render))
+        response = stream.iter_chunks()
+        assert await anext(response) == chunks[0]
+        # The client disconnects
+        await response.aclose()
+        await asyncio.wait_for(rendering, 5)
+        assert out.getvalue() == b"".join(chunks)
+
+    asyncio.run(run())
+
+
+def test_wallpaper_stream_stalled():
+    async def run():
+        stream = WallpaperStream("session", asyncio.get_running_loop())
+        stream.max_stall = 0.05
+        out = io.BytesIO()
+        chunks = [bytes([n]) for n in range(3 * stream.max_chunks)]
+
+        def render():
+            assert stream.claim()
+            writer = stream.writer(out)
+            for chunk in chunks:
+                writer.write(chunk)
+            stream.close()
+
+        # Nobody reads until the render gave up on the client
+        await asyncio.wait_for(asyncio.to_thread(render), 5)
+        assert out.getvalue() == b"".join(chunks)
+        received = []
+        with pytest.raises(RuntimeError):
+            async for chunk in stream.iter_chunks():
+                received.append(chunk)
+        assert received == chunks[: stream.max_chunks]
+
+    asyncio.run(run())
+
+
+def test_wallpaper_stream_cancelled():
+    async def run():
+        stream = WallpaperStream("session", asyncio.get_running_loop())
+        assert stream.cancel()
+        assert not stream.claim()
+
+    asyncio.run(run())
+
+
+def test_generator_demand_completes_started_layout(tmp_path):
+    generator = Generator(
+        download_dir=str(tmp_path / "download"),
+        used_dir=str(tmp_path / "used"),
+        wallpaper_dir=str(tmp_path / "wallpaper"),
+        screen_w=1920,
+        screen_h=1080,
+        logger=logging.getLogger(__name__),
+    )
+    assert generator._demand() is None
+
+    for n in range(3):
+        generator.candidates.add(4, _sub(n, 480, 1080))
+    demand = generator._demand()
+    assert [c.ratios for c in demand] == [[480 / 1080], [480 / 1080]]
+    # Images filling the slot without upscaling come first
+    assert (demand[0].min_width, demand[0].min_height) == (480, 1080)
+
+
+def test_generator_renders_from_memory_backend():
+    backend = MemoryBackend()
+    image = io.BytesIO()
+    Image.new("RGB", (320, 180), "red").save(image, "PNG")
+    backend.put("download/ab/img-1.png", image.getvalue())
+    generator = Generator(
+        download_dir="download",
+        used_dir="used",
+        wallpaper_dir="wallpaper",
+        screen_w=160,
+        screen_h=90,
+        logger=logging.getLogger(__name__),
+        storage_backend=backend,
+    )
+
+    wallpaper = generator.get_next_wallpaper()
+    with Image.open(io.BytesIO(backend.read(wallpaper))) as img:
+        assert img.size == (160, 90)
+        assert img.getpixel((80, 45)) == (255, 0, 0)
+    assert backend.list("download") == []
+    assert len(backend.list("used")) == 1
+
+
+def test_prefetched_wallpapers_outlive_queued_renders():
+    async def run():
+        backend = MemoryBackend()
+        generator = Generator(
+            download_dir="download",
+            used_dir="used",
+            wallpaper_dir="wallpaper",
+            screen_w=160,
+            screen_h=90,
+            logger=logging.getLogger(__name__),
+            max_images=10,
+            is_async=True,
+            max_wallpaper_cnt=20,
+            storage_backend=backend,
+        )
+
+        async def feed():
+            while True:
+                yield generator.storage.save_wallpaper(b"png")
+
+        generator.feed = feed()
+        task = asyncio.create_task(generator.start())
+        prefetched = []
+        for _ in range(2):
+            while not generator.wallpapers_queue.full():
+                await asyncio.sleep(0)
+            prefetched += await generator.aget_next_wallpapers("session", 10)
+        while not generator.wallpapers_queue.full():
+            await asyncio.sleep(0)
+        # Renders waiting in the queue don't push served ones out
+        assert [backend.read(w) for w in prefetched] == [b"png"] * 20
+
+        prefetched += await generator.aget_next_wallpapers("session", 1)
+        # Only the oldest served one is gone
+        with pytest.raises(FileNotFoundError):
+            backend.read(prefetched[0])
+        assert [backend.read(w) for w in prefetched[1:]] == [b"png"] * 20
+        await generator.stop()
+        await task
+
+    asyncio.run(run())
+
+
+def test_wallpaper_stream_slow_client():
+    async def run():
+        stream = WallpaperStream("session", asyncio.get_running_loop())
+        stream.max_stall = 0.2
+        out = io.BytesIO()
+        chunks = [bytes([n]) for n in range(4 * stream.max_chunks)]
+
+        def render():
+            assert stream.claim()
+            writer = stream.writer(out)
+            for chunk in chunks:
+                writer.write(chunk)
+            stream.close()
+
+        rendering = asyncio.create_task(asyncio.to_thread(render))
+        received = []
+        # Each chunk is taken well within max_stall, all of them are not
+        with pytest.raises(RuntimeError):
+            async for chunk in stream.iter_chunks():
+                received.append(chunk)
+                await asyncio.sleep(0.02)
+        await asyncio.wait_for(rendering, 1)
+        assert out.getvalue() == b"".join(chunks)
+        assert len(received) < len(chunks)
+
+    asyncio.run(run())
@@ -0,0 +1,149 @@
+from jopaper import Generator, Generators
+from jopaper.scheduler import PRIORITY_INTERACTIVE, WorkScheduler
+from PIL import Image
+import asyncio
+import logging
+import os
+import threading
+
+
+def _generator(tmp_path, screen_w, screen_h):
+    name = f"{screen_w}x{screen_h}"
+    return Generator(
+        download_dir=os.path.join(tmp_path, "download", name),
+        used_dir=os.path.join(tmp_path, "used", name),
+        wallpaper_dir=os.path.join(tmp_path, "wallpaper", name),
+        screen_w=screen_w,
+        screen_h=screen_h,
+        logger=logging.getLogger(__name__),
+        max_images=10,
+        is_async=True,
+    )
+
+
+def _wallpaper(tmp_path, screen_w, screen_h):
+    filename = os.path.join(tmp_path, f"wallpaper-{screen_w}x{screen_h}.png")
+    Image.new("RGB", (screen_w, screen_h)).save(filename)
+    return filename
+
+
+def test_stale_wallpaper_on_deadline(tmp_path):
+    async def run():
+        generators = Generators(logging.getLogger(__name__))
+        generator = _generator(tmp_path, 1920, 1080)
+        generators.generators[(1920, 1080)] = generator
+        stale = _wallpaper(tmp_path, 1920, 1080)
+        await generator.cache.add(stale, "session")
+
+        wallpaper = await generators.get_wallpaper(1920, 1080, "session", timeout=0.01)
+        assert wallpaper == stale
+
+    asyncio.run(run())
+
+
+def test_rescaled_wallpaper_from_nearest_resolution(tmp_path):
+    async def run():
+        generators = Generators(logging.getLogger(__name__))
+        for w, h in [(1920, 1080), (1080, 1920), (1280, 720)]:
+            generators.generators[(w, h)] = _generator(tmp_path, w, h)
+        for w, h in [(1920, 1080), (1080, 1920)]:
+            stale = _wallpaper(tmp_path, w, h)
+            await generators.generators[(w, h)].cache.add(stale, "other")
+
+        wallpaper = await generators.get_wallpaper(1280, 720, "session", timeout=0.01)
+        with Image.open(wallpaper) as img:
+            assert img.size == (1280, 720)
+        # In one of the hash-prefixed subdirectories
+        assert os.path.dirname(os.path.dirname(wallpaper)) == os.path.join(
+            tmp_path, "wallpaper", "1280x720"
+        )
+        # The nearest resolution is the landscape one
+        assert await generators._nearest_wallpaper(1280, 720) == os.path.join(
+            tmp_path, "wallpaper-1920x1080.png"
+        )
+
+    asyncio.run(run())
+
+
+def test_waiters_follow_removed_generator(tmp_path):
+    async def run():
+        generators = Generators(logging.getLogger(__name__))
+        old = _generator(tmp_path, 1920, 1080)
+        generators.generators[(1920, 1080)] = old
+        generators.tasks[(1920, 1080)] = asyncio.create_task(asyncio.sleep(10))
+        fresh = _wallpaper(tmp_path, 1920, 1080)
+
+        async def new_generator(screen_w, screen_h):
+            new = _generator(tmp_path, screen_w, screen_h)
+            new.wallpapers_queue.put_nowait(fresh)
+            new.start = lambda: asyncio.sleep(0)
+            return new
+
+        generators._new_generator = new_generator
+        waiter = asyncio.create_task(generators.get_wallpaper(1920, 1080, "a"))
+        streamer = asyncio.create_task(generators.get_wallpaper_stream(1920, 1080, "b"))
+        while old.waiting != 2:
+            await asyncio.sleep(0.001)
+
+        async with generators.lock:
+            await generators._remove_generator((1920, 1080))
+        assert await asyncio.wait_for(waiter, 1) == fresh
+        assert await asyncio.wait_for(streamer, 1) == fresh
+
+    asyncio.run(run())
+
+
+def test_concurrent_requests_share_one_rescale(tmp_path):
+    async def run():
+        generators = Generators(logging.getLogger(__name__))
+        for w, h in [(1920, 1080), (1280, 720)]:
+            generators.generators[(w, h)] = _generator(tmp_path, w, h)
+        stale = _wallpaper(tmp_path, 1920, 1080)
+        await generators.generators[(1920, 1080)].cache.add(stale, "other")
+
+        wallpapers = await asyncio.gather(
+            *(
+                generators.get_wallpaper(1280, 720, f"session-{n}", timeout=0.01)
+                for n in range(8)
+            )
+        )
+        generator = generators.generators[(1280, 720)]
+        assert (await generator.cache.get_state())["items"] == 1
+        assert wallpapers == [await generator.aget_latest_wallpaper()] * 8
+        assert generator.waiting == 0
+
+    asyncio.run(run())
+
+
+def test_rescale_dropped_for_fresh_wallpaper(tmp_path):
+    async def run():
+        generators = Generators(logging.getLogger(__name__))
+        for w, h in [(1920, 1080), (1280, 720)]:
+            generators.generators[(w, h)] = _generator(tmp_path, w, h)
+        stale = _wallpaper(tmp_path, 1920, 1080)
+        await generators.generators[(1920, 1080)].cache.add(stale, "other")
+        generator = generators.generators[(1280, 720)]
+        fresh = _wallpaper(tmp_path, 1280, 720)
+        # The only render worker is busy until a fresh wallpaper is ready
+        generator.schedulers = {"render": WorkScheduler("render", 1, generator.logger)}
+        hold = threading.Event()
+        busy = asyncio.create_task(
+            generator.schedulers["render"].run(
+                lambda: hold.wait(5), lambda: PRIORITY_INTERACTIVE
+            )
+        )
+
+        request = asyncio.create_task(
+            generators.get_wallpaper(1280, 720, "session", timeout=0.01)
+        )
+        while generator.adopting is None:
+            await asyncio.sleep(0.001)
+        await generator.wallpapers_queue.put(fresh)
+        assert await asyncio.wait_for(request, 1) == fresh
+        await asyncio.sleep(0)
+        assert generator.adopting.cancelled()
+        hold.set()
+        await busy
+        generator.schedulers["render"].stop()
+
+    asyncio.run(run())
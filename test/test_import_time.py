@@ -0,0 +1,63 @@
+import json
+import os
+import subprocess
+import sys
+
+# Modules only the server needs; the CLI must not load them
+SERVER_ONLY_MODULES = [
+    "jopaper.generator_service",
+    "jopaper.api",
+    "jopaper.tracing",
+    "pydantic_settings",
+    "fastapi",
+    "opentelemetry",
+]
+
+# Generous budget for the whole CLI import chain, in seconds
+CLI_IMPORT_BUDGET = 1.0
+
+
+def _run(code):
+    return subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+
+def _cumulative_us(importtime_output, module):
+    for line in importtime_output.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        # import time: self [us] | cumulative | imported package
+        _, cumulative, name = (p.strip() for p in line.split("|"))
+        if name == module:
+            return int(cumulative)
+    raise AssertionError(f"{module} not found in importtime output")
+
+
+def test_package_import_is_lazy():
+    result = _run("import json, sys, jopaper; print(json.dumps(list(sys.modules)))")
+    loaded = set(json.loads(result.stdout))
+    assert "jopaper.generator" not in loaded
+    assert "PIL" not in loaded
+
+
+def test_cli_does_not_load_server_stack():
+    code = (
+        "import json, sys, jopaper.__main__\n"
+        "from jopaper.generator import Generator\n"
+        "print(json.dumps(list(sys.modules)))"
+    )
+    result = _run(code)
+    loaded = set(json.loads(result.stdout))
+    for module in SERVER_ONLY_MODULES:
+        assert module not in loaded, f"CLI imports {module}"
+
+
+def test_cli_import_time():
+    result = _run("from jopaper.generator import Generator")
+    elapsed = _cumulative_us(result.stderr, "jopaper.generator") / 1e6
+    assert elapsed < CLI_IMPORT_BUDGET
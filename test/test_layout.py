@@ -0,0 +1,93 @@
+from jopaper.generator import LogTracer
+from jopaper.layout import SubImage, Wall, write_png
+from PIL import Image
+import io
+import logging
+import numpy as np
+import os
+import pytest
+import zlib
+
+
+def _source(tmp_path, n, width, height, mode="RGB", ftype="png"):
+    filename = os.path.join(tmp_path, f"img-{n}.{ftype}")
+    x = np.linspace(0, 255, width, dtype=np.uint8)[None, :]
+    y = np.linspace(0, 255, height, dtype=np.uint8)[:, None]
+    pixels = np.stack(np.broadcast_arrays(x, y, x // 2 + y // 2), axis=2)
+    Image.fromarray(pixels).convert(mode).save(filename)
+    return filename
+
+
+def _render(sources, backend, screen_w, screen_h):
+    wall = Wall(screen_w, screen_h, backend=backend)
+    for filename, w, h in sources:
+        sub = SubImage(filename, w, h)
+        sub.to_box(0, 0, screen_w / len(sources), screen_h)
+        wall.add(sub)
+    used, png = wall.get_png(LogTracer(logging.getLogger(__name__)))
+    with Image.open(io.BytesIO(png)) as img:
+        return used, np.asarray(img.convert("RGB"), dtype=np.int16)
+
+
+@pytest.mark.parametrize(
+    "sizes",
+    [
+        [(2000, 1000)],
+        [(600, 1300), (500, 1100), (700, 1500, "RGBA"), (650, 1400, "P")],
+    ],
+)
+def test_numpy_backend_matches_pil(tmp_path, sizes):
+    sources = []
+    for n, size in enumerate(sizes):
+        w, h, *mode = size
+        sources.append((_source(tmp_path, n, w, h, *mode), w, h))
+
+    used_pil, pil = _render(sources, "pil", 1920, 1080)
+    used_np, composited = _render(sources, "numpy", 1920, 1080)
+    assert used_pil == used_np
+    assert pil.shape == composited.shape == (1080, 1920, 3)
+    # Scaling straight from the source box may round differently
+    assert np.abs(pil - composited).mean() < 2
+
+
+@pytest.mark.parametrize("size", [(1920, 1080), (700, 1750)])
+def test_numpy_backend_matches_pil_on_detail(tmp_path, size):
+    # Blocky noise saved as JPEG, closer to real pictures than gradients
+    w, h = size
+    noise = np.random.default_rng(0).integers(0, 255, (h // 8, w // 8, 3))
+    filename = os.path.join(tmp_path, "img.jpeg")
+    Image.fromarray(noise.astype(np.uint8)).resize((w, h)).save(filename, quality=90)
+
+    _, pil = _render([(filename, w, h)], "pil", 1280, 720)
+    _, composited = _render([(filename, w, h)], "numpy", 1280, 720)
+    assert np.abs(pil - composited).max() <= 1
+
+
+def test_numpy_backend_costs_less():
+    costs = {}
+    for backend in ["pil", "numpy"]:
+        wall = Wall(3840, 2160, backend=backend)
+        sub = SubImage("img.png", 1920, 1080)
+        sub.to_box(0, 0, 3840, 2160)
+        wall.add(sub)
+        costs[backend] = wall.get_cost()
+    assert costs["numpy"] < costs["pil"]
+    # Canvas and source, but no scaled copy of the tile
+    assert costs["numpy"] < 3840 * 2160 + 1920 * 1080 + 3840 * 2160 // 4
+
+
+def test_write_png_filter_choice():
+    # Raw bytes of 0x80 are the costliest residuals, not the cheapest
+    pixels = np.full((1, 64, 3), 0x80, dtype=np.uint8)
+    out = io.BytesIO()
+    write_png(pixels, out)
+    png = out.getvalue()
+    data, pos = b"", 8
+    while pos < len(png):
+        length = int.from_bytes(png[pos : pos + 4], "big")
+        if png[pos + 4 : pos + 8] == b"IDAT":
+            data += png[pos + 8 : pos + 8 + length]
+        pos += length + 12
+    assert zlib.decompress(data)[0] == 1  # Sub
+    with Image.open(io.BytesIO(png)) as img:
+        assert (np.asarray(img) == pixels).all()
@@ -0,0 +1,105 @@
+from jopaper import reactor
+import logging
+import numpy as np
+
+
+def _image(width, height, file_type="png"):
+    return reactor.Image(
+        url=f"https://example.com/{width}x{height}.{file_type}",
+        file_type=file_type,
+        tags=[],
+        width=width,
+        height=height,
+    )
+
+
+def test_match_images():
+    images = [
+        _image(1600, 1000),  # matches 1920x1080 single
+        _image(1040, 2000),  # matches 4 in a row for both
+        _image(3440, 1440),  # matches 3440x1440 single
+        _image(1920, 1080, "gif"),  # wrong type
+        _image(100, 100),  # too small
+    ]
+    constraints = [
+        reactor.get_default_constraints(1920, 1080),
+        reactor.get_default_constraints(3440, 1440),
+    ]
+    matched = reactor.match_images(images, constraints)
+    expected = np.array(
+        [
+            [True, False],
+            [True, True],
+            [False, True],
+            [False, False],
+            [False, False],
+        ]
+    )
+    assert (matched == expected).all()
+
+
+def test_match_images_empty():
+    constraints = [reactor.get_default_constraints(1920, 1080)]
+    assert reactor.match_images([], constraints).shape == (0, 1)
+
+
+def test_source_routes_one_page_to_all_resolutions():
+    source = reactor.Source(logging.getLogger(__name__))
+    source.subscribe("fhd", reactor.get_default_constraints(1920, 1080))
+    source.subscribe("wide", reactor.get_default_constraints(3440, 1440))
+    images = [_image(1920, 1080), _image(3440, 1440)]
+    fetches = []
+
+    def fetch():
+        fetches.append(1)
+        source.caches["fhd"].extend(images[:1])
+        source.caches["wide"].extend(images[1:])
+
+    source._fetch = fetch
+    assert source.get_image("fhd") is images[0]
+    assert source.get_image("wide") is images[1]
+    assert len(fetches) == 1
+
+
+def test_source_fetch(monkeypatch):
+    source = reactor.Source(logging.getLogger(__name__))
+    source.subscribe("fhd", reactor.get_default_constraints(1920, 1080))
+    source.subscribe("wide", reactor.get_default_constraints(3440, 1440))
+    images = [_image(1600, 1000), _image(3440, 1440), _image(1040, 2000)]
+    monkeypatch.setattr(source, "_get_more_posts", lambda: [])
+    monkeypatch.setattr(reactor, "_extract_images", lambda posts, logger: images)
+
+    source._fetch()
+    assert list(source.caches["fhd"]) == [images[0], images[2]]
+    assert list(source.caches["wide"]) == [images[1], images[2]]
+
+
+def test_source_prefers_demanded_images():
+    source = reactor.Source(logging.getLogger(__name__))
+    source.subscribe("fhd", reactor.get_default_constraints(1920, 1080))
+    narrow, wide = _image(1040, 2000), _image(1920, 1080)
+    source.caches["fhd"].extend([narrow, wide])
+    narrow_slot = reactor.Constraints(
+        min_width=480, min_height=1080, ratios=[480 / 1080]
+    )
+    source._fetch = lambda: None
+
+    # The newest image is wide, but the started layout needs a narrow one
+    assert source.get_image("fhd", [narrow_slot]) is narrow
+    assert source.get_image("fhd") is wide
+
+
+def test_source_fetches_for_demand_before_settling():
+    source = reactor.Source(logging.getLogger(__name__), demand_fetches=1)
+    source.subscribe("fhd", reactor.get_default_constraints(1920, 1080))
+    wide = _image(1920, 1080)
+    source.caches["fhd"].append(wide)
+    narrow_slot = reactor.Constraints(
+        min_width=480, min_height=1080, ratios=[480 / 1080]
+    )
+    fetches = []
+    source._fetch = lambda: fetches.append(1)
+
+    # Nothing narrow turns up, so the wide image is used after one page
+    assert source.get_image("fhd", [narrow_slot]) is wide
+    assert len(fetches) == 1
@@ -0,0 +1,139 @@
+from jopaper.scheduler import (
+    PRIORITY_INTERACTIVE,
+    PRIORITY_REFILL,
+    RenderBudget,
+    WorkScheduler,
+)
+import asyncio
+import logging
+import threading
+import time
+
+
+def _run(budget, pixels, events, name, hold, priority=None):
+    with budget.reserve(pixels, priority):
+        events.append(f"start {name}")
+        hold.wait(5)
+        events.append(f"end {name}")
+
+
+def test_render_budget_queues_renders_beyond_budget():
+    budget = RenderBudget(max_pixels=100)
+    events = []
+    hold_a = threading.Event()
+    hold_b = threading.Event()
+    a = threading.Thread(target=_run, args=(budget, 80, events, "a", hold_a))
+    b = threading.Thread(target=_run, args=(budget, 50, events, "b", hold_b))
+    a.start()
+    while budget.get_state()["running"] != 1:
+        time.sleep(0.001)
+    b.start()
+    while budget.get_state()["waiting"] != 1:
+        time.sleep(0.001)
+    assert budget.get_state()["used_pixels"] == 80
+
+    hold_b.set()
+    hold_a.set()
+    a.join()
+    b.join()
+    assert events == ["start a", "end a", "start b", "end b"]
+    assert budget.get_state()["used_pixels"] == 0
+
+
+def test_render_budget_admits_urgent_renders_first():
+    budget = RenderBudget(max_pixels=100)
+    events = []
+    hold = threading.Event()
+    hold.set()
+    hold_a = threading.Event()
+    a = threading.Thread(target=_run, args=(budget, 80, events, "a", hold_a))
+    refill = threading.Thread(
+        target=_run, args=(budget, 50, events, "refill", hold, lambda: PRIORITY_REFILL)
+    )
+    urgent = threading.Thread(
+        target=_run,
+        args=(budget, 50, events, "urgent", hold, lambda: PRIORITY_INTERACTIVE),
+    )
+    a.start()
+    while budget.get_state()["running"] != 1:
+        time.sleep(0.001)
+    refill.start()
+    while budget.get_state()["waiting"] != 1:
+        time.sleep(0.001)
+    # Arrives later but a request waits for it
+    urgent.start()
+    while budget.get_state()["waiting"] != 2:
+        time.sleep(0.001)
+
+    hold_a.set()
+    for t in (a, refill, urgent):
+        t.join()
+    assert events.index("start urgent") < events.index("start refill")
+
+
+def test_render_budget_runs_oversized_render_alone():
+    budget = RenderBudget(max_pixels=100)
+    with budget.reserve(500):
+        assert budget.get_state()["used_pixels"] == 500
+
+
+def test_render_budget_unlimited():
+    budget = RenderBudget()
+    with budget.reserve(500), budget.reserve(500):
+        assert budget.get_state()["running"] == 2
+
+
+def test_work_scheduler_runs_urgent_jobs_first():
+    async def run():
+        scheduler = WorkScheduler("test", 1, logging.getLogger(__name__))
+        order = []
+        hold = threading.Event()
+        demand = {"c": PRIORITY_REFILL}
+
+        blocker = asyncio.create_task(
+            scheduler.run(lambda: hold.wait(5), lambda: PRIORITY_REFILL)
+        )
+        while scheduler.get_state()["running"] != 1:
+            await asyncio.sleep(0.001)
+
+        jobs = [
+            asyncio.create_task(
+                scheduler.run(lambda: order.append("a"), lambda: PRIORITY_REFILL)
+            ),
+            asyncio.create_task(
+                scheduler.run(lambda: order.append("b"), lambda: PRIORITY_INTERACTIVE)
+            ),
+        ]
+        # Becomes urgent while waiting
+        jobs.append(
+            asyncio.create_task(
+                scheduler.run(lambda: order.append("c"), lambda: demand["c"])
+            )
+        )
+        await asyncio.sleep(0.01)
+        demand["c"] = PRIORITY_INTERACTIVE
+        hold.set()
+        await asyncio.gather(blocker, *jobs)
+        scheduler.stop()
+        assert order == ["b", "c", "a"]
+
+    asyncio.run(run())
+
+
+def test_work_scheduler_propagates_errors():
+    async def run():
+        scheduler = WorkScheduler("test", 1, logging.getLogger(__name__))
+
+        def fail():
+            raise ValueError("boom")
+
+        try:
+            await scheduler.run(fail, lambda: PRIORITY_REFILL)
+        except ValueError as e:
+            assert str(e) == "boom"
+        else:
+            raise AssertionError("error not propagated")
+        finally:
+            scheduler.stop()
+
+    asyncio.run(run())
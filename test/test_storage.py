@@ -0,0 +1,97 @@
+from jopaper.storage import SeenIndex, Storage
+from jopaper.storage_backends import MemoryBackend
+import logging
+import os
+import pytest
+
+
+def test_seen_index_persists(tmp_path):
+    path = os.path.join(tmp_path, "seen.bin")
+    seen = SeenIndex(path, horizon=10)
+    seen.add("https://example.com/1.png")
+    seen.add("https://example.com/1.png")
+    assert "https://example.com/1.png" in seen
+    assert "https://example.com/2.png" not in seen
+
+    seen = SeenIndex(path, horizon=10)
+    assert "https://example.com/1.png" in seen
+    assert len(seen) == 1
+
+
+def test_seen_index_horizon(tmp_path):
+    path = os.path.join(tmp_path, "seen.bin")
+    seen = SeenIndex(path, horizon=3)
+    urls = [f"https://example.com/{n}.png" for n in range(10)]
+    for url in urls:
+        seen.add(url)
+    assert [url in seen for url in urls] == [False] * 7 + [True] * 3
+    # Compacted on disk to at most twice the horizon
+    assert os.path.getsize(path) <= 2 * 3 * 8
+
+    seen = SeenIndex(path, horizon=3)
+    assert [url in seen for url in urls] == [False] * 7 + [True] * 3
+
+
+def test_seen_index_disabled(tmp_path):
+    path = os.path.join(tmp_path, "seen.bin")
+    seen = SeenIndex(path, horizon=0)
+    seen.add("https://example.com/1.png")
+    assert "https://example.com/1.png" not in seen
+    assert not os.path.exists(path)
+
+
+def _storage(root, backend=None, **kwargs):
+    return Storage(
+        os.path.join(root, "download"),
+        os.path.join(root, "used"),
+        os.path.join(root, "wallpaper"),
+        logging.getLogger(__name__),
+        backend=backend,
+        **kwargs,
+    )
+
+
+def test_storage_shards_and_cleans_wallpapers():
+    storage = _storage("root", MemoryBackend(), max_wallpaper_cnt=2)
+    wallpapers = [storage.save_wallpaper(b"png") for _ in range(5)]
+    for wallpaper in wallpapers:
+        # root/wallpaper/<shard>/wallpaper-...
+        assert len(wallpaper.split("/")) == 4
+
+    old = storage.pop_old_wallpapers()
+    assert sorted(old) == sorted(wallpapers[:3])
+    assert storage.pop_old_wallpapers() == []
+    storage.rm_wallpapers(old)
+    assert sorted(storage.backend.list("root/wallpaper")) == sorted(wallpapers[3:])
+
+
+def test_storage_cleans_wallpapers_without_listing():
+    backend = MemoryBackend()
+    backend.put("root/wallpaper/ab/wallpaper-0.png", b"png")
+    storage = _storage("root", backend, max_wallpaper_cnt=1)
+    wallpaper = storage.save_wallpaper(b"png")
+
+    def fail(prefix):
+        raise AssertionError(f"listed {prefix}")
+
+    backend.list = fail
+    old = storage.pop_old_wallpapers()
+    assert old == ["root/wallpaper/ab/wallpaper-0.png"]
+    storage.rm_wallpapers(old)
+    assert backend.read(wallpaper) == b"png"
+    with pytest.raises(FileNotFoundError):
+        backend.read(old[0])
+
+
+def test_storage_finds_flat_downloads(tmp_path):
+    # Downloads kept before the sharded layout are still used
+    os.makedirs(os.path.join(tmp_path, "download"))
+    flat = os.path.join(tmp_path, "download", "img-1.png")
+    with open(flat, "wb") as f:
+        f.write(b"png")
+    storage = _storage(str(tmp_path))
+    assert storage.get_downloads() == [flat]
+
+    used = storage.mark_used(flat)
+    assert os.path.dirname(os.path.dirname(used)) == os.path.join(tmp_path, "used")
+    assert not os.path.exists(flat)